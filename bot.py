@@ -1,10 +1,13 @@
 import asyncio
+import json
 import logging
+import signal
 
 import aiohttp
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
+from aiogram.dispatcher.storage import BaseStorage
 from gspread_asyncio import AsyncioGspreadClientManager
 
 from tgbot.config import load_config
@@ -16,10 +19,24 @@ from tgbot.handlers.private.manage_outline_server import register_manage_server
 from tgbot.handlers.private.user import register_user
 from tgbot.middlewares.dbmiddleware import DBMiddleware
 from tgbot.models.base import create_db_session
-from tgbot.models.telegram_object import user_read, user_create
+from tgbot.models.telegram_object import user_upsert
+from tgbot.services.chat_member_events import ChatMemberEvents
+from tgbot.services.outline_server_api import outline_ssl_context
 
 logger = logging.getLogger(__name__)
 
+BOT_USER_CACHE_TTL = 86400
+FSM_STORAGE_PREFIX = 'ilfree_fsm'
+
+# Order matters: admin /start must precede user /start and echo handlers must be the last ones
+HANDLER_REGISTRARS = (
+    register_admin,
+    register_user,
+    register_service_handlers,
+    register_manage_server,
+    register_echo,
+)
+
 
 def register_all_middlewares(dp):
     dp.setup_middleware(DBMiddleware())
@@ -30,11 +47,39 @@ def register_all_filters(dp):
 
 
 def register_all_handlers(dp):
-    register_admin(dp)
-    register_user(dp)
-    register_service_handlers(dp)
-    register_manage_server(dp)
-    register_echo(dp)
+    for register in HANDLER_REGISTRARS:
+        register(dp)
+
+
+def bot_user_cache_key(bot: Bot) -> str:
+    return f"bot:me:{bot.id}"
+
+
+async def fetch_bot_user(bot: Bot, storage: BaseStorage) -> types.User:
+    """Return the bot user cached in Redis, getMe is called only on a cache miss"""
+    if isinstance(storage, RedisStorage2):
+        redis = await storage.redis()
+        cached = await redis.get(bot_user_cache_key(bot))
+        if cached:
+            return types.User.to_object(json.loads(cached))
+    return await bot.me
+
+
+async def bootstrap_bot_user(bot: Bot, storage: BaseStorage, bot_user: types.User):
+    # The upsert is idempotent and cheap, it is always done so a recreated database gets the bot user back
+    await user_upsert(bot['db_session'],
+                      id=bot_user.id,
+                      is_bot=bot_user.is_bot,
+                      first_name=bot_user.first_name,
+                      last_name=bot_user.last_name,
+                      username=bot_user.username,
+                      mention=bot_user.mention,
+                      lang_code=bot_user.language_code,
+                      role='user'
+                      )
+    if isinstance(storage, RedisStorage2):
+        redis = await storage.redis()
+        await redis.set(bot_user_cache_key(bot), bot_user.as_json(), ex=BOT_USER_CACHE_TTL)
 
 
 async def main():
@@ -43,28 +88,30 @@ async def main():
         format=u'%(filename)s:%(lineno)d #%(levelname)-8s [%(asctime)s] - %(name)s - %(message)s',
     )
     logger.info("Starting bot")
-    config = load_config(".env")
-
-    storage = RedisStorage2() if config.tg_bot.use_redis else MemoryStorage()
+    config = await asyncio.to_thread(load_config, ".env")
+
+    if config.tg_bot.use_redis:
+        storage = RedisStorage2(host=config.redis.host,
+                                port=config.redis.port,
+                                db=config.redis.db,
+                                password=config.redis.password,
+                                pool_size=config.redis.pool_size,
+                                prefix=FSM_STORAGE_PREFIX,
+                                state_ttl=config.redis.state_ttl,
+                                data_ttl=config.redis.data_ttl)
+    else:
+        logger.warning("FSM states are kept in memory and will be lost on restart. "
+                       "Set USE_REDIS=True in production.")
+        storage = MemoryStorage()
     bot = Bot(token=config.tg_bot.token, parse_mode='HTML')
     dp = Dispatcher(bot, storage=storage)
 
     bot['config'] = config
-    bot['http_session']: aiohttp.ClientSession = aiohttp.ClientSession()
-    bot['db_session'] = await create_db_session(config)
-    db_bot_user = await user_read(bot['db_session'], id=bot.id)
-    if not db_bot_user:
-        bot_user = await bot.me
-        await user_create(bot['db_session'],
-                          id=bot_user.id,
-                          is_bot=bot_user.is_bot,
-                          first_name=bot_user.first_name,
-                          last_name=bot_user.last_name,
-                          username=bot_user.username,
-                          mention=bot_user.mention,
-                          lang_code=bot_user.language_code,
-                          role='user'
-                          )
+    bot['db_session'], bot_user = await asyncio.gather(create_db_session(config),
+                                                       fetch_bot_user(bot, storage))
+    await bootstrap_bot_user(bot, storage, bot_user)
+    bot['chat_member_events'] = ChatMemberEvents(bot['db_session'])
+    bot['chat_member_events'].start()
 
     google_client_manager: AsyncioGspreadClientManager = AsyncioGspreadClientManager(
         config.misc.scoped_credentials
@@ -75,15 +122,42 @@ async def main():
     register_all_handlers(dp)
 
     # start
+    bot['http_session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(ssl=outline_ssl_context(),
+                                       limit=200,
+                                       limit_per_host=50,
+                                       keepalive_timeout=60,
+                                       ttl_dns_cache=300,
+                                       enable_cleanup_closed=True),
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={"User-Agent": "ilfree-bot/1.0"}
+    )
+    bot['last_sync'] = {}
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, dp.stop_polling)
+        except NotImplementedError:
+            pass
+
     try:
         await dp.start_polling()
     finally:
         await dp.storage.close()
         await dp.storage.wait_closed()
-        await bot.session.close()
+        await bot['chat_member_events'].close()
+        await asyncio.gather(bot['http_session'].close(),
+                             bot['db_session'].kw['bind'].dispose(),
+                             bot.session.close(),
+                             return_exceptions=True)
 
 
 if __name__ == '__main__':
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
@@ -1,11 +1,18 @@
 from dataclasses import dataclass
-from typing import List, Any
+from functools import lru_cache, partial
+from typing import Any, Optional, FrozenSet, Tuple
 
 from environs import Env
 from google.oauth2.service_account import Credentials
 
+GOOGLE_CREDENTIALS_FILE = 'tgbot/config-google.json'
+GOOGLE_SCOPES = (
+    "https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
+    "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"
+)
 
-@dataclass
+
+@dataclass(frozen=True)
 class DbConfig:
     dialect: str
     user: str
@@ -13,50 +20,65 @@ class DbConfig:
     host: str
     database: str
     echo: bool
+    pool_size: int
+    max_overflow: int
+    pool_recycle: int
+    pool_pre_ping: bool
+    sqlite_timeout: int
+
+
+@dataclass(frozen=True)
+class RedisConfig:
+    host: str
+    port: int
+    db: int
+    password: Optional[str]
+    pool_size: int
+    state_ttl: Optional[int]
+    data_ttl: Optional[int]
 
 
-@dataclass
+@dataclass(frozen=True)
 class TgBot:
     token: str
-    admin_ids: List[int]
+    admin_ids: FrozenSet[int]
     use_redis: bool
 
 
-@dataclass
+@dataclass(frozen=True)
 class Miscellaneous:
     other_params: str = None
     scoped_credentials: Any = None
 
 
-@dataclass
+@dataclass(frozen=True)
 class Config:
     tg_bot: TgBot
     db: DbConfig
+    redis: RedisConfig
     misc: Miscellaneous
 
 
-def get_scoped_credentials(credentials, scopes):
-    def prepare_credentials():
-        return credentials.with_scopes(scopes)
+@lru_cache(maxsize=None)
+def load_google_credentials(path: str) -> Credentials:
+    return Credentials.from_service_account_file(path)
+
 
-    return prepare_credentials
+def load_scoped_credentials(credentials_file: str, scopes: Tuple[str, ...]) -> Credentials:
+    return load_google_credentials(credentials_file).with_scopes(scopes)
 
 
+@lru_cache(maxsize=1)
 def load_config(path: str = None):
     env = Env()
     env.read_env(path)
 
-    scopes = [
-        "https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-        "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"
-    ]
-    google_credentials = Credentials.from_service_account_file('tgbot/config-google.json')
-    scoped_credentials = get_scoped_credentials(google_credentials, scopes)
+    scoped_credentials = partial(load_scoped_credentials, GOOGLE_CREDENTIALS_FILE, GOOGLE_SCOPES)
 
     return Config(
         tg_bot=TgBot(
             token=env.str("BOT_TOKEN"),
-            admin_ids=list(map(int, env.list("ADMINS"))),
+            admin_ids=frozenset(map(int, env.list("ADMINS"))),
             use_redis=env.bool("USE_REDIS"),
         ),
         db=DbConfig(
@@ -65,7 +87,21 @@ def load_config(path: str = None):
             password=env.str('DB_PASS'),
             database=env.str('DB_NAME'),
             host=env.str('DB_HOST'),
-            echo=env.bool('DB_ECHO')
+            echo=env.bool('DB_ECHO'),
+            pool_size=env.int('DB_POOL_SIZE', 20),
+            max_overflow=env.int('DB_MAX_OVERFLOW', 40),
+            pool_recycle=env.int('DB_POOL_RECYCLE', 3600),
+            pool_pre_ping=env.bool('DB_POOL_PRE_PING', False),
+            sqlite_timeout=env.int('DB_SQLITE_TIMEOUT', 30)
+        ),
+        redis=RedisConfig(
+            host=env.str('REDIS_HOST', 'localhost'),
+            port=env.int('REDIS_PORT', 6379),
+            db=env.int('REDIS_DB', 0),
+            password=env.str('REDIS_PASS', None) or None,
+            pool_size=env.int('REDIS_POOL_SIZE', 50),
+            state_ttl=env.int('REDIS_STATE_TTL', 3600) or None,
+            data_ttl=env.int('REDIS_DATA_TTL', 3600) or None
         ),
         misc=Miscellaneous(
             scoped_credentials=scoped_credentials
@@ -1,45 +1,49 @@
+import asyncio
 import logging
 
 from aiogram import types, Dispatcher
 from aiogram.types import ChatMember
-from sqlalchemy.orm import sessionmaker
 
-from tgbot.models.telegram_object import chat_member_read, chat_member_create, chat_member_delete
+from tgbot.services.chat_member_events import ChatMemberEvents
 
 logger = logging.getLogger(__name__)
 
+NEW_MEMBERS_CONCURRENCY = 10
 
-async def new_chat_member(message: types.Message):
-    Session: sessionmaker = message.bot.get('db_session')
 
+async def new_chat_member(message: types.Message, chat_member_events: ChatMemberEvents):
     logger.info("New chat member(s) in chat %s", message.chat.title)
-    for telegram_user in message.new_chat_members:
-        db_chat_member = await chat_member_read(Session, chat_id=message.chat.id, user_id=telegram_user.id)
-        telegram_chat_member: ChatMember = await message.chat.get_member(telegram_user.id)
-
-        if not db_chat_member:
-            db_chat_member = await chat_member_create(Session,
-                                                      chat_id=message.chat.id,
-                                                      user_id=telegram_user.id,
-                                                      status=telegram_chat_member.status)
-            if db_chat_member:
-                logger.info("New chat member %s in chat %s added to database chat_members table",
-                            telegram_user.mention, message.chat.title)
-        else:
-            logger.info("New chat member %s in chat %s already exist in database chat_members table",
-                        telegram_user.mention, message.chat.title)
-
-
-async def left_chat_member(message: types.Message):
-    Session: sessionmaker = message.bot.get('db_session')
-
-    logger.info("Chat member %s left chat %s", message.left_chat_member.mention, message.chat.title)
-    result = await chat_member_delete(Session,
-                                      chat_id=message.chat.id,
-                                      user_id=message.left_chat_member.id)
-    if result:
-        logger.info("Chat member %s from chat %s deleted from database chat_members table",
-                    message.left_chat_member.mention, message.chat.title)
+    semaphore = asyncio.Semaphore(NEW_MEMBERS_CONCURRENCY)
+
+    async def get_member(telegram_user: types.User) -> ChatMember:
+        async with semaphore:
+            return await message.chat.get_member(telegram_user.id)
+
+    telegram_chat_members = await asyncio.gather(*(get_member(telegram_user)
+                                                   for telegram_user in message.new_chat_members))
+    for telegram_user, telegram_chat_member in zip(message.new_chat_members, telegram_chat_members):
+        await chat_member_events.join(chat_id=message.chat.id,
+                                      user_id=telegram_user.id,
+                                      status=telegram_chat_member.status,
+                                      user=dict(id=telegram_user.id,
+                                                is_bot=telegram_user.is_bot,
+                                                first_name=telegram_user.first_name,
+                                                last_name=telegram_user.last_name,
+                                                username=telegram_user.username,
+                                                mention=telegram_user.mention,
+                                                lang_code=telegram_user.language_code,
+                                                role='user'))
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("New chat member(s) %s in chat %s queued for database chat_members table",
+                    ", ".join(telegram_user.mention for telegram_user in message.new_chat_members),
+                    message.chat.title)
+
+
+async def left_chat_member(message: types.Message, chat_member_events: ChatMemberEvents):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Chat member %s left chat %s", message.left_chat_member.mention, message.chat.title)
+    await chat_member_events.leave(chat_id=message.chat.id,
+                                   user_id=message.left_chat_member.id)
 
 
 def register_service_handlers(dp: Dispatcher):
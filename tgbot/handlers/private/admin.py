@@ -1,10 +1,9 @@
 from aiogram import Dispatcher
 from aiogram.dispatcher import FSMContext
-from aiogram.types import Message, ChatActions, ReplyKeyboardRemove
+from aiogram.types import Message, ReplyKeyboardRemove
 
 
 async def admin_start(message: Message, state: FSMContext):
-    await ChatActions.typing()
     await state.finish()
     await message.reply("Hello, admin!", reply_markup=ReplyKeyboardRemove())
 
@@ -1,33 +1,56 @@
+import asyncio
 import ipaddress
 import logging
+import time
+from functools import lru_cache
+from typing import Optional
 from urllib.parse import quote
 
-from aiogram import Dispatcher
+from aiogram import Bot, Dispatcher
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup, State
-from aiogram.types import Message, ChatActions, CallbackQuery, ForceReply
-from aiogram.utils.markdown import text
-
-from tgbot.keyboards.inline import edit_server_keyboard, myservers_callback, Action, servers_list_keyboard, \
-    server_action_keyboard, confirm_keyboard, server_keys_keyboard, CALLBACK_CACHE_TIME, key_action_keyboard
-from tgbot.misc.utils import size_human_read_format
+from aiogram.types import Message, ChatActions, CallbackQuery, ForceReply, InlineKeyboardMarkup
+from aiogram.utils.exceptions import MessageNotModified, BadRequest
+from cachetools import TTLCache
+from sqlalchemy.orm import sessionmaker
+
+from tgbot.keyboards.inline import edit_server_keyboard, myservers_callback, Action, servers_list_layout, \
+    server_action_keyboard, confirm_keyboard, server_keys_keyboard, CALLBACK_CACHE_TIME, key_action_keyboard, \
+    layout_markup, LIST_ROW_WIDTH
+from tgbot.misc.utils import size_human_read_format, single_flight
 from tgbot.models.outline_server import server_create, OutlineServer, server_read, server_delete, \
-    server_update, server_key_sync, server_key_create, server_key_read, server_key_update, server_key_delete
-from tgbot.services.outline_server_api import OutlineVPN
+    server_update, server_key_sync, server_key_create, server_key_read, server_key_update, server_key_delete, \
+    server_key_read_access_url, server_key_list, get_outline_vpn
 
 logger = logging.getLogger(__name__)
 
-INVITE_MESSAGE = """Приглашаю вас подключиться к моему серверу Outline. 
+SERVER_CACHE_SIZE = 512
+SERVER_CACHE_TTL = 5
+server_cache: TTLCache = TTLCache(maxsize=SERVER_CACHE_SIZE, ttl=SERVER_CACHE_TTL)
+# IPv4Address/IPv6Address objects are immutable, so parsed values are safe to share
+parse_ip = lru_cache(maxsize=1024)(ipaddress.ip_address)
+SERVERS_KEYBOARD_CACHE_TTL = 30
+servers_keyboard_cache: TTLCache = TTLCache(maxsize=1, ttl=SERVERS_KEYBOARD_CACHE_TTL)
+servers_keyboard_version = 0
+
+KEYS_SYNC_INTERVAL = 10
+
+SERVER_EDIT_ACTIONS = [Action.SERVER_EDIT_NAME, Action.SERVER_EDIT_IP, Action.SERVER_EDIT_URL, Action.SERVER_EDIT_STATE]
+KEY_EDIT_ACTIONS = [Action.KEY_SEND, Action.KEY_EDIT_NAME]
+
+INVITE_MESSAGE_HEAD = """Приглашаю вас подключиться к моему серверу Outline. 
 С его помощью вы получите доступ к свободному Интернету, где бы вы ни находились. 
 Воспользуйтесь инструкциями по приведенной в приглашении ссылке, чтобы скачать приложение Outline и создать подключение.
 
-https://s3.amazonaws.com/outline-vpn/invite.html#{}
+https://s3.amazonaws.com/outline-vpn/invite.html#"""
+INVITE_MESSAGE_MIDDLE = """
 
 -----
 
 Есть проблемы с доступом к пригласительной ссылке?
 
-Скопируйте ключ доступа: {}
+Скопируйте ключ доступа: """
+INVITE_MESSAGE_TAIL = """
 Воспользуйтесь нашими инструкциями на GitHub: https://github.com/Jigsaw-Code/outline-client/blob/master/docs/"""
 
 
@@ -42,11 +65,80 @@ class ManageServer(StatesGroup):
     update_key_name = State()
 
 
+# Prompt and state for server edit actions which ask for a new value
+SERVER_EDIT_PROMPTS = {
+    Action.SERVER_EDIT_NAME: ('OK. Please send new name of server {}.', ManageServer.update_name),
+    Action.SERVER_EDIT_IP: ('OK. Please send new server ip for {}.', ManageServer.update_ip),
+    Action.SERVER_EDIT_URL: ('OK. Please send new url for {}.', ManageServer.update_url),
+}
+
+
+async def cached_server_read(Session: sessionmaker, ip: str) -> Optional[OutlineServer]:
+    server = server_cache.get(ip)
+    if server is None:
+        server = await server_read(Session, ip=parse_ip(ip))
+        if server:
+            server_cache[ip] = server
+    return server
+
+
+async def cached_servers_list_keyboard(Session: sessionmaker) -> InlineKeyboardMarkup:
+    layout = servers_keyboard_cache.get(servers_keyboard_version)
+    if layout is None:
+        version = servers_keyboard_version
+        # Concurrent first renders of the same version share one database query
+        layout = await single_flight(('servers_keyboard', version), lambda: servers_list_layout(Session))
+        # Store only if servers were not changed while the keyboard was being built
+        if version == servers_keyboard_version:
+            servers_keyboard_cache[version] = layout
+    return layout_markup(layout, LIST_ROW_WIDTH)
+
+
+def keys_recently_synced(bot: Bot, server_ip) -> bool:
+    return time.monotonic() - bot['last_sync'].get(str(server_ip), 0) < KEYS_SYNC_INTERVAL
+
+
+def mark_keys_synced(bot: Bot, server_ip):
+    bot['last_sync'][str(server_ip)] = time.monotonic()
+
+
+def invalidate_server_cache(*ips):
+    global servers_keyboard_version
+    servers_keyboard_version += 1
+    servers_keyboard_cache.clear()
+    for ip in ips:
+        server_cache.pop(str(ip), None)
+
+
+def invite_message(access_url: str) -> str:
+    return f"{INVITE_MESSAGE_HEAD}{quote(access_url)}{INVITE_MESSAGE_MIDDLE}{access_url}{INVITE_MESSAGE_TAIL}"
+
+
+async def replace_message(message: Message, chat_id: int, message_id: int,
+                          message_text: str, markup: InlineKeyboardMarkup):
+    """Edit bot message with inline keyboard in place, resend it if it can not be edited anymore"""
+    try:
+        await message.bot.edit_message_text(text=message_text,
+                                            chat_id=chat_id,
+                                            message_id=message_id,
+                                            reply_markup=markup,
+                                            disable_web_page_preview=True)
+    except MessageNotModified:
+        pass
+    except BadRequest as e:
+        logger.info("Could not edit message %i, sending a new one. %r", message_id, e)
+        await message.answer(message_text,
+                             reply_markup=markup,
+                             disable_web_page_preview=True)
+        await message.bot.delete_message(message_id=message_id,
+                                         chat_id=chat_id)
+
+
 def server_info_text(server: OutlineServer) -> str:
-    return text(f'Server name: {server.name}\n'
-                f'IP address: {str(server.ip)}\n'
-                f'Server url: {server.url}\n'
-                f'State: {"✅ Active" if server.is_active else "🚫 Active"}\n')
+    return (f'Server name: {server.name}\n'
+            f'IP address: {server.ip}\n'
+            f'Server url: {server.url}\n'
+            f'State: {"✅ Active" if server.is_active else "🚫 Active"}\n')
 
 
 async def new_server(message: Message, state: FSMContext):
@@ -59,31 +151,27 @@ async def new_server(message: Message, state: FSMContext):
 
 async def enter_server_name(message: Message, state: FSMContext):
     await ChatActions.typing()
-    async with state.proxy() as data:
-        data['server_name'] = message.text.strip()
-    await message.answer(text(f"Well, server name: <b>{message.text.strip()}.</b>\n"
-                              f"Please enter server IP address."),
+    await state.update_data(server_name=message.text.strip())
+    await message.answer(f"Well, server name: <b>{message.text.strip()}.</b>\n"
+                         f"Please enter server IP address.",
                          reply_markup=ForceReply())
     await ManageServer.enter_ip.set()
 
 
 async def update_server_name(message: Message, state: FSMContext):
     await ChatActions.typing()
-    async with state.proxy() as data:
-        server_name = message.text.strip()
-        server_ip = data['server_ip']
-        message_id = data.get('message_id')
-        chat_id = data.get('chat_id')
-    server = await server_update(message.bot['db_session'], primary_key_ip=ipaddress.ip_address(server_ip),
+    server_name = message.text.strip()
+    data = await state.get_data()
+    server_ip = data['server_ip']
+    message_id = data.get('message_id')
+    chat_id = data.get('chat_id')
+    server = await server_update(message.bot['db_session'], primary_key_ip=parse_ip(server_ip),
                                  name=server_name)
-    markup = await edit_server_keyboard(str(server.ip), server.is_active)
+    invalidate_server_cache(server_ip)
+    markup = edit_server_keyboard(str(server.ip), server.is_active)
     if message_id and chat_id:
         try:
-            await message.answer(server_info_text(server),
-                                 reply_markup=markup,
-                                 disable_web_page_preview=True)
-            await message.bot.delete_message(message_id=message_id,
-                                             chat_id=chat_id)
+            await replace_message(message, chat_id, message_id, server_info_text(server), markup)
         except Exception as e:
             logger.error("Error occurred while working with message.\n%r", e)
     await state.finish()
@@ -92,21 +180,21 @@ async def update_server_name(message: Message, state: FSMContext):
 async def enter_server_ip(message: Message, state: FSMContext):
     await ChatActions.typing()
     try:
-        server_ip = ipaddress.ip_address(message.text)
-        async with state.proxy() as data:
-            server_name = data['server_name']
-            data['server_ip'] = str(server_ip)
+        server_ip = parse_ip(message.text)
+        data = await state.get_data()
+        server_name = data['server_name']
+        await state.update_data(server_ip=str(server_ip))
 
     except ValueError:
-        logger.error(f"Wrong IP address: {message.text}")
+        logger.error("Wrong IP address: %s", message.text)
         await message.answer("Wrong IP address. \nPlease enter correct server IP address.",
                              reply_markup=ForceReply())
         await ManageServer.enter_ip.set()
         return
 
-    await message.answer(text(f"Well, server name: <b>{server_name}.</b>\n"
-                              f"IP address: <b>{str(server_ip)}</b>\n"
-                              f"Please enter server manage url."),
+    await message.answer(f"Well, server name: <b>{server_name}.</b>\n"
+                         f"IP address: <b>{server_ip}</b>\n"
+                         f"Please enter server manage url.",
                          reply_markup=ForceReply())
     await ManageServer.enter_url.set()
 
@@ -114,59 +202,57 @@ async def enter_server_ip(message: Message, state: FSMContext):
 async def update_server_ip(message: Message, state: FSMContext):
     await ChatActions.typing()
     try:
-        server_ip = ipaddress.ip_address(message.text)
-        async with state.proxy() as data:
-            primary_key_ip = data.get('server_ip', str(server_ip))
-            data['server_ip'] = str(server_ip)
-            message_id = data.get('message_id')
-            chat_id = data.get('chat_id')
+        server_ip = parse_ip(message.text)
+        data = await state.get_data()
+        primary_key_ip = data.get('server_ip', str(server_ip))
+        message_id = data.get('message_id')
+        chat_id = data.get('chat_id')
+        await state.update_data(server_ip=str(server_ip))
     except ValueError:
-        logger.error(f"Wrong IP address: {message.text}")
+        logger.error("Wrong IP address: %s", message.text)
         await message.answer("Wrong IP address. \nPlease enter correct server IP address.",
                              reply_markup=ForceReply())
         await ManageServer.update_ip.set()
         return
 
-    server = await server_update(message.bot['db_session'], primary_key_ip=ipaddress.ip_address(primary_key_ip),
+    server = await server_update(message.bot['db_session'], primary_key_ip=parse_ip(primary_key_ip),
                                  ip=server_ip)
-    markup = await edit_server_keyboard(str(server.ip), server.is_active)
+    invalidate_server_cache(primary_key_ip, server_ip)
+    markup = edit_server_keyboard(str(server.ip), server.is_active)
     if message_id and chat_id:
-        await message.answer(server_info_text(server),
-                             reply_markup=markup,
-                             disable_web_page_preview=True)
-        await message.bot.delete_message(message_id=message_id,
-                                         chat_id=chat_id)
+        await replace_message(message, chat_id, message_id, server_info_text(server), markup)
     await state.finish()
 
 
 async def enter_server_url(message: Message, state: FSMContext):
     await ChatActions.typing()
     try:
-        async with state.proxy() as data:
-            server_name = data['server_name']
-            server_ip = ipaddress.ip_address(data['server_ip'])
-            server_url = message.text
-
-            server: OutlineServer = await server_create(message.bot['db_session'],
-                                                        ip=server_ip,
-                                                        url=server_url,
-                                                        name=server_name)
-            if not server:
-                logger.error(f"Something went wrong. Could not create server object in DB.")
-                await message.answer("Something went wrong.\nPlease issue /newserver command again.")
-                await state.finish()
-                return
+        data = await state.get_data()
+        server_name = data['server_name']
+        server_ip = parse_ip(data['server_ip'])
+        server_url = message.text
+
+        server: OutlineServer = await server_create(message.bot['db_session'],
+                                                    ip=server_ip,
+                                                    url=server_url,
+                                                    name=server_name)
+        invalidate_server_cache(server_ip)
+        if not server:
+            logger.error("Something went wrong. Could not create server object in DB.")
+            await message.answer("Something went wrong.\nPlease issue /newserver command again.")
+            await state.finish()
+            return
     except ValueError:
-        logger.error(f"Wrong server manage url: {message.text}")
+        logger.error("Wrong server manage url: %s", message.text)
         await message.answer("Wrong server manage url.\nPlease enter correct server manage url.")
         await ManageServer.enter_url.set()
         return
     except Exception as err:
-        logger.error(f"Something went wrong. {err=}, {type(err)=}")
+        logger.error("Something went wrong. err=%r, type(err)=%r", err, type(err))
         await message.answer("Something went wrong.\nPlease issue /newserver command again.")
         await state.finish()
         return
-    markup = await edit_server_keyboard(str(server.ip), server.is_active)
+    markup = edit_server_keyboard(str(server.ip), server.is_active)
     await message.answer(f'New server was added.\n' + server_info_text(server),
                          reply_markup=markup,
                          disable_web_page_preview=True)
@@ -176,29 +262,26 @@ async def enter_server_url(message: Message, state: FSMContext):
 async def update_server_url(message: Message, state: FSMContext):
     await ChatActions.typing()
     try:
-        async with state.proxy() as data:
-            server_name = data['server_name']
-            server_ip = ipaddress.ip_address(data['server_ip'])
-            server_url = message.text
-            message_id = data.get('message_id')
-            chat_id = data.get('chat_id')
-
-            server = await server_update(message.bot['db_session'], primary_key_ip=server_ip,
-                                         url=server_url)
-            markup = await edit_server_keyboard(str(server.ip), server.is_active)
-            if message_id and chat_id:
-                await message.answer(server_info_text(server),
-                                     reply_markup=markup,
-                                     disable_web_page_preview=True)
-                await message.bot.delete_message(message_id=message_id,
-                                                 chat_id=chat_id)
-            await state.finish()
+        data = await state.get_data()
+        server_name = data['server_name']
+        server_ip = parse_ip(data['server_ip'])
+        server_url = message.text
+        message_id = data.get('message_id')
+        chat_id = data.get('chat_id')
+
+        server = await server_update(message.bot['db_session'], primary_key_ip=server_ip,
+                                     url=server_url)
+        invalidate_server_cache(server_ip)
+        markup = edit_server_keyboard(str(server.ip), server.is_active)
+        if message_id and chat_id:
+            await replace_message(message, chat_id, message_id, server_info_text(server), markup)
+        await state.finish()
     except ValueError:
-        logger.error(f"Wrong server manage url: {message.text}")
+        logger.error("Wrong server manage url: %s", message.text)
         await message.answer("Wrong server manage url.\nPlease enter correct server manage url.")
         await ManageServer.update_url.set()
     except Exception as err:
-        logger.error(f"Something went wrong. {err=}, {type(err)=}")
+        logger.error("Something went wrong. err=%r, type(err)=%r", err, type(err))
         await message.answer("Something went wrong.\nPlease issue /myservers command again.")
         await state.finish()
 
@@ -206,16 +289,15 @@ async def update_server_url(message: Message, state: FSMContext):
 async def myservers(message: Message, state: FSMContext):
     await ChatActions.typing()
     await state.finish()
-    markup = await servers_list_keyboard(message.bot['db_session'])
+    markup = await cached_servers_list_keyboard(message.bot['db_session'])
     await message.answer(text='Choose a server from the list below:',
                          reply_markup=markup,
                          disable_web_page_preview=True)
 
 
 async def myservers_call(call: CallbackQuery, callback_data: dict, state: FSMContext):
-    await ChatActions.typing()
     await state.finish()
-    markup = await servers_list_keyboard(call.message.bot['db_session'])
+    markup = await cached_servers_list_keyboard(call.message.bot['db_session'])
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
     await call.message.edit_text(text='Choose a server from the list below:',
                                  reply_markup=markup,
@@ -223,9 +305,8 @@ async def myservers_call(call: CallbackQuery, callback_data: dict, state: FSMCon
 
 
 async def server_actions(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await server_action_keyboard(str(server.ip))
+    server = await cached_server_read(call.message.bot['db_session'], callback_data['ip'])
+    markup = server_action_keyboard(str(server.ip))
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
 
     await call.message.edit_text(f"Now server is: {server.name} ({str(server.ip)})\nWhat do you want to do?",
@@ -235,9 +316,8 @@ async def server_actions(call: CallbackQuery, callback_data: dict):
 
 
 async def edit_server(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await edit_server_keyboard(str(server.ip), server.is_active)
+    server = await cached_server_read(call.message.bot['db_session'], callback_data['ip'])
+    markup = edit_server_keyboard(str(server.ip), server.is_active)
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
 
     await call.message.edit_text(server_info_text(server),
@@ -247,11 +327,10 @@ async def edit_server(call: CallbackQuery, callback_data: dict):
 
 
 async def delete_server_confirm(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await confirm_keyboard(callback_data['ip'], "",
-                                    Action.SERVER_DELETE,
-                                    Action.SERVER_CHOOSE_ACTION)
+    server = await cached_server_read(call.message.bot['db_session'], callback_data['ip'])
+    markup = confirm_keyboard(callback_data['ip'], "",
+                              Action.SERVER_DELETE,
+                              Action.SERVER_CHOOSE_ACTION)
     await call.message.edit_text("Are you sure delete the server?\n" + server_info_text(server),
                                  reply_markup=markup)
 
@@ -259,8 +338,9 @@ async def delete_server_confirm(call: CallbackQuery, callback_data: dict):
 async def delete_server(call: CallbackQuery, callback_data: dict):
     await ChatActions.typing()
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    result = await server_delete(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await servers_list_keyboard(call.message.bot['db_session'])
+    result = await server_delete(call.message.bot['db_session'], ip=parse_ip(callback_data['ip']))
+    invalidate_server_cache(callback_data['ip'])
+    markup = await cached_servers_list_keyboard(call.message.bot['db_session'])
     await call.message.edit_text(text='Choose a server from the list below:',
                                  reply_markup=markup,
                                  disable_web_page_preview=True)
@@ -268,44 +348,44 @@ async def delete_server(call: CallbackQuery, callback_data: dict):
 
 async def edit_server_params(call: CallbackQuery, callback_data: dict, state: FSMContext):
     await ChatActions.typing()
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
+    server = await cached_server_read(call.message.bot['db_session'], callback_data['ip'])
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    async with state.proxy() as data:
-        data['server_name'] = server.name
-        data['server_ip'] = str(server.ip)
-        data['server_url'] = server.url
-        data['message_id'] = call.message.message_id
-        data['chat_id'] = call.message.chat.id
-    if callback_data["action"] == Action.SERVER_EDIT_NAME:
-        message = await call.message.answer(f'OK. Please send new name of server {server.name}.',
-                                            reply_markup=ForceReply())
-        await ManageServer.update_name.set()
-    elif callback_data["action"] == Action.SERVER_EDIT_IP:
-        message = await call.message.answer(f'OK. Please send new server ip for {server.name}.',
-                                            reply_markup=ForceReply())
-        await ManageServer.update_ip.set()
-    elif callback_data["action"] == Action.SERVER_EDIT_URL:
-        message = await call.message.answer(f'OK. Please send new url for {server.name}.',
-                                            reply_markup=ForceReply())
-        await ManageServer.update_url.set()
+    await state.update_data(server_name=server.name,
+                            server_ip=str(server.ip),
+                            server_url=server.url,
+                            message_id=call.message.message_id,
+                            chat_id=call.message.chat.id)
+    if callback_data["action"] in SERVER_EDIT_PROMPTS:
+        prompt, new_state = SERVER_EDIT_PROMPTS[callback_data["action"]]
+        message = await call.message.answer(prompt.format(server.name), reply_markup=ForceReply())
+        await new_state.set()
     elif callback_data["action"] == Action.SERVER_EDIT_STATE:
         server = await server_update(call.message.bot['db_session'],
                                      primary_key_ip=server.ip,
                                      is_active=not server.is_active)
-        markup = await edit_server_keyboard(str(server.ip), server.is_active)
+        invalidate_server_cache(server.ip)
+        markup = edit_server_keyboard(str(server.ip), server.is_active)
         await call.message.edit_text(server_info_text(server),
                                      reply_markup=markup,
                                      disable_web_page_preview=True)
 
 
 async def show_keys(call: CallbackQuery, callback_data: dict, state: FSMContext):
-    await ChatActions.typing()
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
+    await call.message.answer_chat_action(ChatActions.TYPING)
+    server_ip = parse_ip(callback_data['ip'])
+    server = await cached_server_read(call.message.bot['db_session'], callback_data['ip'])
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    server_keys = await server_key_sync(call.message.bot['db_session'],
-                                        aiohttp_session=call.message.bot['http_session'],
-                                        server_ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await server_keys_keyboard(ipaddress.ip_address(callback_data['ip']), server_keys)
+    if keys_recently_synced(call.message.bot, server_ip):
+        server_keys = await server_key_list(call.message.bot['db_session'], server_ip=server_ip)
+    else:
+        server_keys, synced = await single_flight(
+            ('sync', callback_data['ip']),
+            lambda: server_key_sync(call.message.bot['db_session'],
+                                    aiohttp_session=call.message.bot['http_session'],
+                                    server_ip=server_ip))
+        if synced:
+            mark_keys_synced(call.message.bot, server_ip)
+    markup = server_keys_keyboard(callback_data['ip'], server_keys)
     await call.message.edit_text(f"Keys on {server.name}",
                                  reply_markup=markup,
                                  disable_web_page_preview=True)
@@ -313,67 +393,73 @@ async def show_keys(call: CallbackQuery, callback_data: dict, state: FSMContext)
 
 async def new_key(call: CallbackQuery, callback_data: dict, state: FSMContext):
     await ChatActions.typing()
-    await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    await call.message.answer(text("Please enter key name."), reply_markup=ForceReply())
+    await asyncio.gather(call.answer(cache_time=CALLBACK_CACHE_TIME),
+                         call.message.answer("Please enter key name.", reply_markup=ForceReply()))
     await ManageServer.enter_key_name.set()
-    async with state.proxy() as data:
-        data['server_ip'] = callback_data['ip']
-        data['message_id'] = call.message.message_id
-        data['chat_id'] = call.message.chat.id
+    await state.update_data(server_ip=callback_data['ip'],
+                            message_id=call.message.message_id,
+                            chat_id=call.message.chat.id)
+
+
+async def send_invite(message: Message, chat_id: int, access_url: str):
+    try:
+        await message.bot.send_message(chat_id=chat_id,
+                                       text=invite_message(access_url))
+    except Exception as e:
+        logger.error("Error while sending invite message.\n %r", e)
 
 
 async def enter_key_name(message: Message, state: FSMContext):
-    await ChatActions.typing()
+    await message.answer_chat_action(ChatActions.TYPING)
     key_name = message.text.strip()
     user_id = message.from_user.id
-    async with state.proxy() as data:
-        server_ip = ipaddress.ip_address(data['server_ip'])
-        message_id = data.get('message_id')
-        chat_id = data.get('chat_id')
+    data = await state.get_data()
+    server_ip = parse_ip(data['server_ip'])
+    message_id = data.get('message_id')
+    chat_id = data.get('chat_id')
     try:
-        server = await server_read(message.bot['db_session'], ip=server_ip)
-        server_key = await server_key_create(message.bot['db_session'],
-                                             message.bot['http_session'],
-                                             server_ip=server_ip,
-                                             key_name=key_name)
+        server, server_key = await asyncio.gather(
+            cached_server_read(message.bot['db_session'], str(server_ip)),
+            server_key_create(message.bot['db_session'],
+                              message.bot['http_session'],
+                              server_ip=server_ip,
+                              key_name=key_name))
+        sync = server_key_sync(message.bot['db_session'],
+                               aiohttp_session=message.bot['http_session'],
+                               server_ip=server_ip)
         if server_key:
-            await message.bot.send_message(chat_id=user_id,
-                                           text=INVITE_MESSAGE.format(quote(server_key.access_url),
-                                                                      server_key.access_url))
-        server_keys = await server_key_sync(message.bot['db_session'],
-                                            aiohttp_session=message.bot['http_session'],
-                                            server_ip=server_ip)
-        markup = await server_keys_keyboard(server_ip, server_keys)
+            (server_keys, synced), _ = await asyncio.gather(sync, send_invite(message, user_id, server_key.access_url))
+        else:
+            server_keys, synced = await sync
+        if synced:
+            mark_keys_synced(message.bot, server_ip)
+        markup = server_keys_keyboard(server_ip, server_keys)
         if message_id and chat_id:
-            await message.answer(f"Keys on {server.name}",
-                                 reply_markup=markup,
-                                 disable_web_page_preview=True)
-            await message.bot.delete_message(message_id=message_id,
-                                             chat_id=chat_id)
+            await replace_message(message, chat_id, message_id, f"Keys on {server.name}", markup)
     except Exception as e:
         logger.error("Error while create new server key.\n %r", e)
     await state.finish()
 
 
 async def update_key_name(message: Message, state: FSMContext):
-    await ChatActions.typing()
+    await message.answer_chat_action(ChatActions.TYPING)
     key_name = message.text.strip()
-    async with state.proxy() as data:
-        server_ip = ipaddress.ip_address(data['server_ip'])
-        key_id = int(data['key_id'])
+    data = await state.get_data()
+    server_ip = parse_ip(data['server_ip'])
+    key_id = data['key_id']
     try:
-        server = await server_read(message.bot['db_session'], ip=server_ip)
-        vpn = OutlineVPN(api_url=server.url, session=message.bot['http_session'], logger=logger)
+        server = await cached_server_read(message.bot['db_session'], str(server_ip))
+        vpn = get_outline_vpn(server.url, message.bot['http_session'])
         result = await vpn.rename_key(key_id=key_id, new_name=key_name)
         if result:
             server_key = await server_key_update(message.bot['db_session'],
                                                  server_ip=server_ip,
                                                  key_id=key_id,
                                                  name=key_name)
-            markup = await key_action_keyboard(ip_address=server_ip, key_id=key_id)
-            await message.answer(text(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
-                                      f"Used bytes: {server_key.used_bytes:,}\n"
-                                      f"What do you want to do?"),
+            markup = key_action_keyboard(ip_address=server_ip, key_id=key_id)
+            await message.answer(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
+                                 f"Used bytes: {server_key.used_bytes:,}\n"
+                                 f"What do you want to do?",
                                  reply_markup=markup,
                                  disable_web_page_preview=True
                                  )
@@ -383,76 +469,88 @@ async def update_key_name(message: Message, state: FSMContext):
 
 
 async def key_actions(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
     server_key = await server_key_read(call.message.bot['db_session'],
-                                       server_ip=ipaddress.ip_address(callback_data['ip']),
-                                       key_id=int(callback_data['key_id']))
-    markup = await key_action_keyboard(ip_address=callback_data['ip'], key_id=callback_data['key_id'])
+                                       server_ip=parse_ip(callback_data['ip']),
+                                       key_id=callback_data['key_id'])
+    markup = key_action_keyboard(ip_address=callback_data['ip'], key_id=callback_data['key_id'])
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    print(server_key.used_bytes)
-    await call.message.edit_text(text(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
-                                      f"Used bytes: {size_human_read_format(server_key.used_bytes)}\n"
-                                      f"What do you want to do?"),
+    await call.message.edit_text(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
+                                 f"Used bytes: {size_human_read_format(server_key.used_bytes)}\n"
+                                 f"What do you want to do?",
                                  reply_markup=markup,
                                  disable_web_page_preview=True
                                  )
 
 
 async def delete_key_confirm(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
-    markup = await confirm_keyboard(callback_data['ip'], callback_data['key_id'],
-                                    Action.KEY_DELETE,
-                                    Action.KEY_CHOOSE_ACTION)
+    markup = confirm_keyboard(callback_data['ip'], callback_data['key_id'],
+                              Action.KEY_DELETE,
+                              Action.KEY_CHOOSE_ACTION)
     server_key = await server_key_read(call.message.bot['db_session'],
-                                       server_ip=ipaddress.ip_address(callback_data['ip']),
-                                       key_id=int(callback_data['key_id']))
-    await call.message.edit_text(text(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
-                                      f"Used bytes: {size_human_read_format(server_key.used_bytes)}\n\n"
-                                      f"Are you sure to delete this key?"),
+                                       server_ip=parse_ip(callback_data['ip']),
+                                       key_id=callback_data['key_id'])
+    await call.message.edit_text(f"Key name: {server_key.name or 'Key id ' + str(server_key.key_id)}\n"
+                                 f"Used bytes: {size_human_read_format(server_key.used_bytes)}\n\n"
+                                 f"Are you sure to delete this key?",
                                  reply_markup=markup,
                                  disable_web_page_preview=True
                                  )
 
 
 async def delete_key(call: CallbackQuery, callback_data: dict):
-    await ChatActions.typing()
-    await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    server = await server_read(call.message.bot['db_session'], ip=ipaddress.ip_address(callback_data['ip']))
-    await server_key_delete(call.message.bot['db_session'],
-                            call.message.bot['http_session'],
-                            server_ip=ipaddress.ip_address(callback_data['ip']),
-                            key_id=int(callback_data['key_id']))
-    server_keys = await server_key_sync(call.message.bot['db_session'],
-                                        aiohttp_session=call.message.bot['http_session'],
-                                        server_ip=ipaddress.ip_address(callback_data['ip']))
-    markup = await server_keys_keyboard(ipaddress.ip_address(callback_data['ip']), server_keys)
+    await call.message.answer_chat_action(ChatActions.TYPING)
+    server_ip = parse_ip(callback_data['ip'])
+    # An expired callback query must not abort the handler while the key is being deleted
+    answered, server, server_keys = await asyncio.gather(
+        call.answer(cache_time=CALLBACK_CACHE_TIME),
+        cached_server_read(call.message.bot['db_session'], callback_data['ip']),
+        server_key_delete(call.message.bot['db_session'],
+                          call.message.bot['http_session'],
+                          server_ip=server_ip,
+                          key_id=callback_data['key_id']),
+        return_exceptions=True)
+    if isinstance(answered, Exception):
+        logger.info("Could not answer callback query %s. %r", call.id, answered)
+    if isinstance(server_keys, Exception):
+        logger.error("Error while deleting server key.\n %r", server_keys)
+        server_keys = None
+    if isinstance(server, Exception):
+        logger.error("Error while reading server %s.\n %r", callback_data['ip'], server)
+        return
+    if server_keys is None:
+        server_keys, synced = await server_key_sync(call.message.bot['db_session'],
+                                                    aiohttp_session=call.message.bot['http_session'],
+                                                    server_ip=server_ip)
+        if synced:
+            mark_keys_synced(call.message.bot, server_ip)
+    markup = server_keys_keyboard(callback_data['ip'], server_keys)
     await call.message.edit_text(f"Keys on {server.name}",
                                  reply_markup=markup,
                                  disable_web_page_preview=True)
 
 
 async def edit_key_params(call: CallbackQuery, callback_data: dict, state: FSMContext):
-    await ChatActions.typing()
     await call.answer(cache_time=CALLBACK_CACHE_TIME)
-    server_ip = ipaddress.ip_address(callback_data['ip'])
+    server_ip = parse_ip(callback_data['ip'])
     key_id = callback_data['key_id']
-    async with state.proxy() as data:
-        data['server_ip'] = str(server_ip)
-        data['key_id'] = key_id
-    server_key = await server_key_read(call.message.bot['db_session'],
-                                       server_ip=server_ip,
-                                       key_id=int(key_id))
+    await state.update_data(server_ip=str(server_ip), key_id=key_id)
 
     if callback_data["action"] == Action.KEY_SEND:
-        if server_key:
+        access_url = await server_key_read_access_url(call.message.bot['db_session'],
+                                                      server_ip=server_ip,
+                                                      key_id=key_id)
+        if access_url:
             await call.message.bot.send_message(chat_id=call.from_user.id,
-                                                text=INVITE_MESSAGE.format(quote(server_key.access_url),
-                                                                           server_key.access_url),
+                                                text=invite_message(access_url),
                                                 disable_web_page_preview=True)
 
     elif callback_data["action"] == Action.KEY_EDIT_NAME:
-        message = await call.message.answer(f'OK. Please send new key name for {server_key.name}.',
-                                            reply_markup=ForceReply())
+        server_key = await server_key_read(call.message.bot['db_session'],
+                                           server_ip=server_ip,
+                                           key_id=key_id)
+        await call.message.answer(f"OK. Please send new key name for "
+                                  f"{server_key.name or 'Key id ' + str(server_key.key_id)}.",
+                                  reply_markup=ForceReply())
         await ManageServer.update_key_name.set()
 
 
@@ -477,17 +575,13 @@ def register_manage_server(dp: Dispatcher):
     dp.register_callback_query_handler(delete_server,
                                        myservers_callback.filter(action=Action.SERVER_DELETE))
     dp.register_callback_query_handler(edit_server_params,
-                                       myservers_callback.filter(action=[Action.SERVER_EDIT_NAME,
-                                                                         Action.SERVER_EDIT_IP,
-                                                                         Action.SERVER_EDIT_URL,
-                                                                         Action.SERVER_EDIT_STATE]))
+                                       myservers_callback.filter(action=SERVER_EDIT_ACTIONS))
     dp.register_callback_query_handler(show_keys, myservers_callback.filter(action=Action.SERVER_SHOW_KEYS))
     dp.register_callback_query_handler(new_key, myservers_callback.filter(action=Action.KEY_NEW))
     dp.register_callback_query_handler(key_actions,
                                        myservers_callback.filter(action=Action.KEY_CHOOSE_ACTION), state='*')
     dp.register_callback_query_handler(edit_key_params,
-                                       myservers_callback.filter(action=[Action.KEY_SEND,
-                                                                         Action.KEY_EDIT_NAME]))
+                                       myservers_callback.filter(action=KEY_EDIT_ACTIONS))
     dp.register_callback_query_handler(delete_key_confirm,
                                        myservers_callback.filter(action=Action.KEY_CONFIRM_DELETE))
     dp.register_callback_query_handler(delete_key,
@@ -1,152 +1,181 @@
-from dataclasses import dataclass
-from typing import List
+from enum import IntEnum
+from functools import lru_cache
+from ipaddress import ip_address, IPv4Address, IPv6Address
+from typing import List, Dict, Any, Tuple, Union
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.callback_data import CallbackData
 from sqlalchemy.orm import sessionmaker
 
-from tgbot.models.outline_server import servers_list, ServerKey
-
-
-# Callback actions
-@dataclass(frozen=True)
-class Action:
-    SERVER_SHOW_LIST: str = '01'
-    SERVER_CHOOSE_ACTION: str = '06'
-    SERVER_EDIT: str = '11'
-    SERVER_CONFIRM_DELETE: str = '16'
-    SERVER_DELETE: str = '21'
-    SERVER_SHOW_KEYS: str = '26'
-    SERVER_EDIT_NAME: str = '31'
-    SERVER_EDIT_IP: str = '36'
-    SERVER_EDIT_URL: str = '41'
-    SERVER_EDIT_STATE: str = '46'
-    KEY_CHOOSE_ACTION: str = '51'
-    KEY_NEW: str = '56'
-    KEY_SEND: str = '61'
-    KEY_EDIT_NAME: str = '66'
-    KEY_CONFIRM_DELETE: str = '71'
-    KEY_DELETE: str = '76'
-
-
-myservers_callback = CallbackData("server", "action", "ip", "key_id")
+from tgbot.models.outline_server import servers_stream, ServerKey
+
+
+CALLBACK_PARSE_CACHE_SIZE = 1024
+
+
+# Callback actions, sent as two digits codes
+class Action(IntEnum):
+    SERVER_SHOW_LIST = 1
+    SERVER_CHOOSE_ACTION = 6
+    SERVER_EDIT = 11
+    SERVER_CONFIRM_DELETE = 16
+    SERVER_DELETE = 21
+    SERVER_SHOW_KEYS = 26
+    SERVER_EDIT_NAME = 31
+    SERVER_EDIT_IP = 36
+    SERVER_EDIT_URL = 41
+    SERVER_EDIT_STATE = 46
+    KEY_CHOOSE_ACTION = 51
+    KEY_NEW = 56
+    KEY_SEND = 61
+    KEY_EDIT_NAME = 66
+    KEY_CONFIRM_DELETE = 71
+    KEY_DELETE = 76
+
+
+class ServerCallbackData(CallbackData):
+    """
+    Server callback data factory which parses action into Action, ip from its hex code and key_id into integer
+    """
+
+    def __init__(self, prefix: str, *parts: str, sep: str = ':'):
+        super().__init__(prefix, *parts, sep=sep)
+        # Every callback query filter parses the same string again, decoded values are shared
+        self.__decode = lru_cache(maxsize=CALLBACK_PARSE_CACHE_SIZE)(self.__decode_uncached)
+
+    def __decode_uncached(self, callback_data: str) -> Dict[str, Any]:
+        data = super().parse(callback_data)
+        data['action'] = Action(int(data['action']))
+        data['ip'] = decode_ip(data['ip'])
+        data['key_id'] = int(data['key_id']) if data.get('key_id') else None
+        return data
+
+    def parse(self, callback_data: str) -> Dict[str, Any]:
+        return dict(self.__decode(callback_data))
+
+
+@lru_cache(maxsize=1024)
+def encode_ip(ip: Union[str, IPv4Address, IPv6Address]) -> str:
+    """
+    Encode ip address as fixed width hex string: 8 chars for IPv4, 32 chars for IPv6.
+    It is shorter than dotted notation and has no ':' which is callback data separator.
+    """
+    address = ip_address(ip)
+    return format(int(address), '08x' if address.version == 4 else '032x')
+
+
+@lru_cache(maxsize=1024)
+def decode_ip(handle: str) -> str:
+    # Keyboards sent before hex encoding carry dotted IPv4 addresses
+    if '.' in handle:
+        return str(ip_address(handle))
+    value = int(handle, 16)
+    return str(IPv4Address(value) if len(handle) == 8 else IPv6Address(value))
+
+
+myservers_callback = ServerCallbackData("server", "action", "ip", "key_id")
+# Precomputed "server:<action>:" prefixes, same layout as produced by myservers_callback.new()
+CALLBACK_PREFIXES = {action: f"{myservers_callback.prefix}{myservers_callback.sep}{action:02d}{myservers_callback.sep}"
+                     for action in Action}
 CALLBACK_CACHE_TIME = 3
+KEYBOARD_CACHE_SIZE = 1024
+LIST_ROW_WIDTH = 2
+DEFAULT_ROW_WIDTH = 3
 
+# Keyboards are cached as immutable rows of (text, callback_data) pairs,
+# every caller gets its own InlineKeyboardMarkup built from them
+KeyboardLayout = Tuple[Tuple[Tuple[str, str], ...], ...]
 
-async def confirm_keyboard(ip_address: str, key_id: str, yes_action: str, no_action: str) -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    markup.row(InlineKeyboardButton(text='Yes',
-                                    callback_data=myservers_callback.new(action=yes_action,
-                                                                         ip=ip_address,
-                                                                         key_id=key_id)),
-               InlineKeyboardButton(text='No',
-                                    callback_data=myservers_callback.new(action=no_action,
-                                                                         ip=ip_address,
-                                                                         key_id=key_id))
-               )
-    return markup
+
+def button_rows(buttons: List[Any], row_width: int) -> List[List[Any]]:
+    return [buttons[i:i + row_width] for i in range(0, len(buttons), row_width)]
+
+
+def server_callback(action: Action, ip: Union[str, IPv4Address, IPv6Address],
+                    key_id: Union[int, str] = "") -> str:
+    """
+    Build server callback data without CallbackData.new() validation overhead.
+    Longest value "server:76:<32 hex chars of IPv6>:<key_id>" fits into Telegram 64 bytes limit.
+    """
+    return f"{CALLBACK_PREFIXES[action]}{encode_ip(ip)}{myservers_callback.sep}{key_id}"
+
+
+def layout_markup(layout: KeyboardLayout, row_width: int = DEFAULT_ROW_WIDTH) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(row_width=row_width,
+                                inline_keyboard=[[InlineKeyboardButton(text=text, callback_data=callback_data)
+                                                  for text, callback_data in row]
+                                                 for row in layout])
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def confirm_layout(ip_address: str, key_id: str, yes_action: Action, no_action: Action) -> KeyboardLayout:
+    return ((('Yes', server_callback(yes_action, ip_address, key_id)),
+             ('No', server_callback(no_action, ip_address, key_id))),)
+
+
+def confirm_keyboard(ip_address: str, key_id: str, yes_action: Action, no_action: Action) -> InlineKeyboardMarkup:
+    return layout_markup(confirm_layout(ip_address, key_id, yes_action, no_action))
+
+
+async def servers_list_layout(Session: sessionmaker) -> KeyboardLayout:
+    buttons = [("✅ " + server.name if server.is_active else "🚫 " + server.name,
+                server_callback(Action.SERVER_CHOOSE_ACTION, server.ip))
+               async for server in servers_stream(Session)]
+    return tuple(tuple(row) for row in button_rows(buttons, LIST_ROW_WIDTH))
 
 
 async def servers_list_keyboard(Session: sessionmaker) -> InlineKeyboardMarkup:
-    servers = await servers_list(Session)
-    row_buttons = (InlineKeyboardButton(text="✅ " + server.name if server.is_active else "🚫 " + server.name,
-                                        callback_data=myservers_callback.new(action=Action.SERVER_CHOOSE_ACTION,
-                                                                             ip=server.ip,
-                                                                             key_id="")) for server in servers)
-    markup = InlineKeyboardMarkup(row_width=2)
-    _ = list(markup.insert(button) for button in row_buttons)
-    return markup
-
-
-async def server_action_keyboard(ip_address: str) -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    markup.row(InlineKeyboardButton(text='📝 Edit',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_EDIT,
-                                                                         ip=ip_address,
-                                                                         key_id="")),
-               InlineKeyboardButton(text='🗑 Delete',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_CONFIRM_DELETE,
-                                                                         ip=ip_address,
-                                                                         key_id="")),
-               InlineKeyboardButton(text='🔑 Keys',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_SHOW_KEYS,
-                                                                         ip=ip_address,
-                                                                         key_id=""))
-               )
-
-    markup.add(InlineKeyboardButton(text='<< Back to servers list',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_SHOW_LIST,
-                                                                         ip=ip_address,
-                                                                         key_id="")))
-
-    return markup
-
-
-async def edit_server_keyboard(ip_address: str, is_active: bool = True) -> InlineKeyboardMarkup:
+    return layout_markup(await servers_list_layout(Session), LIST_ROW_WIDTH)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def server_action_layout(ip_address: str) -> KeyboardLayout:
+    return ((('📝 Edit', server_callback(Action.SERVER_EDIT, ip_address)),
+             ('🗑 Delete', server_callback(Action.SERVER_CONFIRM_DELETE, ip_address)),
+             ('🔑 Keys', server_callback(Action.SERVER_SHOW_KEYS, ip_address))),
+            (('<< Back to servers list', server_callback(Action.SERVER_SHOW_LIST, ip_address)),))
+
+
+def server_action_keyboard(ip_address: str) -> InlineKeyboardMarkup:
+    return layout_markup(server_action_layout(ip_address))
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def edit_server_layout(ip_address: str, is_active: bool = True) -> KeyboardLayout:
     state = "✅ Active" if is_active else "🚫 Active"
-    markup = InlineKeyboardMarkup()
-    markup.row(InlineKeyboardButton(text='📝 Name',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_EDIT_NAME,
-                                                                         ip=ip_address,
-                                                                         key_id="")),
-               InlineKeyboardButton(text='📝 IP',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_EDIT_IP,
-                                                                         ip=ip_address,
-                                                                         key_id="")),
-               InlineKeyboardButton(text='📝 url',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_EDIT_URL,
-                                                                         ip=ip_address,
-                                                                         key_id="")),
-               InlineKeyboardButton(text=state,
-                                    callback_data=myservers_callback.new(action=Action.SERVER_EDIT_STATE,
-                                                                         ip=ip_address,
-                                                                         key_id=""))
-               )
-    markup.add(InlineKeyboardButton(text='<< Back to server',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_CHOOSE_ACTION,
-                                                                         ip=ip_address,
-                                                                         key_id="")))
-    return markup
-
-
-async def server_keys_keyboard(ip_address: str, server_keys: List[ServerKey]) -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    row_buttons = (InlineKeyboardButton(text=key.name if len(key.name) else "<...>",
-                                        callback_data=myservers_callback.new(action=Action.KEY_CHOOSE_ACTION,
-                                                                             ip=ip_address,
-                                                                             key_id=key.key_id)) for key in server_keys)
-    markup = InlineKeyboardMarkup(row_width=2)
-    _ = list(markup.insert(button) for button in row_buttons)
-    markup.add(InlineKeyboardButton(text='🔑 New key',
-                                    callback_data=myservers_callback.new(action=Action.KEY_NEW,
-                                                                         ip=ip_address,
-                                                                         key_id="")))
-    markup.add(InlineKeyboardButton(text='<< Back to server',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_CHOOSE_ACTION,
-                                                                         ip=ip_address,
-                                                                         key_id="")))
-    return markup
-
-
-async def key_action_keyboard(ip_address: str, key_id: int) -> InlineKeyboardMarkup:
-    markup = InlineKeyboardMarkup()
-    markup.row(InlineKeyboardButton(text='🔑 Send key',
-                                    callback_data=myservers_callback.new(action=Action.KEY_SEND,
-                                                                         ip=ip_address,
-                                                                         key_id=key_id)),
-               InlineKeyboardButton(text='📝 Rename',
-                                    callback_data=myservers_callback.new(action=Action.KEY_EDIT_NAME,
-                                                                         ip=ip_address,
-                                                                         key_id=key_id)),
-               InlineKeyboardButton(text='🗑 Delete',
-                                    callback_data=myservers_callback.new(action=Action.KEY_CONFIRM_DELETE,
-                                                                         ip=ip_address,
-                                                                         key_id=key_id))
-               )
-
-    markup.add(InlineKeyboardButton(text='<< Back to keys',
-                                    callback_data=myservers_callback.new(action=Action.SERVER_SHOW_KEYS,
-                                                                         ip=ip_address,
-                                                                         key_id="")))
-
-    return markup
+    return ((('📝 Name', server_callback(Action.SERVER_EDIT_NAME, ip_address)),
+             ('📝 IP', server_callback(Action.SERVER_EDIT_IP, ip_address)),
+             ('📝 url', server_callback(Action.SERVER_EDIT_URL, ip_address)),
+             (state, server_callback(Action.SERVER_EDIT_STATE, ip_address))),
+            (('<< Back to server', server_callback(Action.SERVER_CHOOSE_ACTION, ip_address)),))
+
+
+def edit_server_keyboard(ip_address: str, is_active: bool = True) -> InlineKeyboardMarkup:
+    return layout_markup(edit_server_layout(ip_address, is_active))
+
+
+def server_keys_keyboard(ip_address: str, server_keys: List[ServerKey]) -> InlineKeyboardMarkup:
+    return layout_markup(keys_layout(ip_address, tuple((key.key_id, key.name) for key in server_keys)),
+                         LIST_ROW_WIDTH)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def keys_layout(ip_address: str, keys: Tuple[Tuple[int, str], ...]) -> KeyboardLayout:
+    buttons = [(name or "<...>", server_callback(Action.KEY_CHOOSE_ACTION, ip_address, key_id))
+               for key_id, name in keys]
+    rows = [tuple(row) for row in button_rows(buttons, LIST_ROW_WIDTH)]
+    rows.append((('🔑 New key', server_callback(Action.KEY_NEW, ip_address)),))
+    rows.append((('<< Back to server', server_callback(Action.SERVER_CHOOSE_ACTION, ip_address)),))
+    return tuple(rows)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def key_action_layout(ip_address: str, key_id: int) -> KeyboardLayout:
+    return ((('🔑 Send key', server_callback(Action.KEY_SEND, ip_address, key_id)),
+             ('📝 Rename', server_callback(Action.KEY_EDIT_NAME, ip_address, key_id)),
+             ('🗑 Delete', server_callback(Action.KEY_CONFIRM_DELETE, ip_address, key_id))),
+            (('<< Back to keys', server_callback(Action.SERVER_SHOW_KEYS, ip_address)),))
+
+
+def key_action_keyboard(ip_address: str, key_id: int) -> InlineKeyboardMarkup:
+    return layout_markup(key_action_layout(ip_address, key_id))
@@ -1,118 +1,94 @@
+import asyncio
 import logging
 
 from aiogram import types
 from aiogram.dispatcher.middlewares import LifetimeControllerMiddleware
+from cachetools import TTLCache
 from sqlalchemy.orm import sessionmaker
 
-from tgbot.models.telegram_object import user_read, user_create, user_update, chat_read, chat_create, chat_update, \
-    chat_member_read, chat_member_create, chat_member_update, chat_member_delete
+from tgbot.models.telegram_object import telegram_state_upsert, begin_read_cache
 
 logger = logging.getLogger(__name__)
 
+PRIVATE_CHAT_TYPE = str(types.ChatType.PRIVATE)
+
+# Users and chats synced to database recently, keyed by (chat_id, user_id)
+SYNC_CACHE_SIZE = 10000
+SYNC_CACHE_TTL = 60
+sync_cache = TTLCache(maxsize=SYNC_CACHE_SIZE, ttl=SYNC_CACHE_TTL)
+
 
 class DBMiddleware(LifetimeControllerMiddleware):
+    """
+    Stores user, chat and chat members of a message in a single transaction before handlers run.
+    Handlers get sessionmaker in data['db_session'], model helpers open a short transaction per call,
+    so no transaction is held while a handler waits for Telegram or Outline VPN API.
+    """
     skip_patterns = ["error", "update"]
 
     async def pre_process(self, obj, data, *args):
+        Session: sessionmaker = obj.bot.get('db_session')
+        data['db_session'] = Session
+        data['chat_member_events'] = obj.bot.get('chat_member_events')
 
         if not isinstance(obj, types.Message):
+            begin_read_cache()
             return
 
-        Session: sessionmaker = obj.bot.get('db_session')
-
         telegram_user: types.User = obj.from_user
         telegram_chat: types.Chat = obj.chat
 
-        db_user = await user_read(Session, id=telegram_user.id)
-        if not db_user:
-            db_user = await user_create(Session,
-                                        id=telegram_user.id,
-                                        is_bot=telegram_user.is_bot,
-                                        first_name=telegram_user.first_name,
-                                        last_name=telegram_user.last_name,
-                                        username=telegram_user.username,
-                                        mention=telegram_user.mention,
-                                        lang_code=telegram_user.language_code,
-                                        role='user')
-        else:
-            db_user = await user_update(Session,
-                                        id=telegram_user.id,
-                                        is_bot=telegram_user.is_bot,
-                                        first_name=telegram_user.first_name,
-                                        last_name=telegram_user.last_name,
-                                        username=telegram_user.username,
-                                        mention=telegram_user.mention,
-                                        lang_code=telegram_user.language_code)
+        sync_key = (telegram_chat.id, telegram_user.id)
+        profile = (telegram_user.is_bot, telegram_user.first_name, telegram_user.last_name, telegram_user.username,
+                   telegram_user.mention, telegram_user.language_code,
+                   telegram_chat.type, telegram_chat.title, telegram_chat.username)
+        synced = sync_cache.get(sync_key)
+        if synced and synced[0] == profile:
+            data['user'], data['chat'], data['chat_member'] = synced[1]
+            begin_read_cache(data['user'], data['chat'])
+            return
 
-        db_chat_member = None
+        db_user = dict(id=telegram_user.id,
+                       is_bot=telegram_user.is_bot,
+                       first_name=telegram_user.first_name,
+                       last_name=telegram_user.last_name,
+                       username=telegram_user.username,
+                       mention=telegram_user.mention,
+                       lang_code=telegram_user.language_code,
+                       role='user')
         db_chat = None
-        if telegram_chat.type != str(types.ChatType.PRIVATE):
-            telegram_chat_member = None
-            bot_chat_member = None
-            try:
-                telegram_chat_member = await telegram_chat.get_member(telegram_user.id)
-            except Exception as e:
+        members = []
+        left_members = []
+        if telegram_chat.type != PRIVATE_CHAT_TYPE:
+            telegram_chat_member, bot_chat_member = await asyncio.gather(telegram_chat.get_member(telegram_user.id),
+                                                                         telegram_chat.get_member(obj.bot.id),
+                                                                         return_exceptions=True)
+            if isinstance(telegram_chat_member, Exception):
                 logger.info("Middleware: Error while issue User in Chat for %s (%i) - %r",
-                            telegram_chat.title, telegram_chat.id, e)
-            try:
-                bot_chat_member = await telegram_chat.get_member(obj.bot.id)
-            except Exception as e:
+                            telegram_chat.title, telegram_chat.id, telegram_chat_member)
+                telegram_chat_member = None
+            if isinstance(bot_chat_member, Exception):
                 logger.info("Middleware: Error while issue Bot in Chat for %s (%i) - %r",
-                            telegram_chat.title, obj.bot.id, e)
-
-            db_chat = await chat_read(Session, id=telegram_chat.id)
-            if not db_chat:
-                db_chat = await chat_create(Session,
-                                            id=telegram_chat.id,
-                                            title=telegram_chat.title,
-                                            username=telegram_chat.username,
-                                            type=telegram_chat.type)
-            else:
-                db_chat = await chat_update(Session,
-                                            id=telegram_chat.id,
-                                            title=telegram_chat.title,
-                                            username=telegram_chat.username,
-                                            type=telegram_chat.type)
-
-            db_chat_member = await chat_member_read(Session,
-                                                    chat_id=telegram_chat.id,
-                                                    user_id=telegram_user.id)
-            if not db_chat_member and telegram_chat_member:
-                db_chat_member = await chat_member_create(Session,
-                                                          chat_id=telegram_chat.id,
-                                                          user_id=telegram_user.id,
-                                                          status=telegram_chat_member.status)
-            elif db_chat_member and not telegram_chat_member:
-                await chat_member_delete(Session,
-                                         chat_id=telegram_chat.id,
-                                         user_id=telegram_user.id)
-                db_chat_member = await chat_member_read(Session,
-                                                        chat_id=telegram_chat.id,
-                                                        user_id=telegram_user.id)
-            else:
-                db_chat_member = await chat_member_update(Session,
-                                                          chat_id=telegram_chat.id,
-                                                          user_id=telegram_user.id,
-                                                          status=telegram_chat_member.status)
+                            telegram_chat.title, obj.bot.id, bot_chat_member)
+                bot_chat_member = None
 
-            db_bot_chat_member = await chat_member_read(Session,
-                                                        chat_id=telegram_chat.id,
-                                                        user_id=obj.bot.id)
-            if not db_bot_chat_member and bot_chat_member:
-                db_bot_chat_member = await chat_member_create(Session,
-                                                              chat_id=telegram_chat.id,
-                                                              user_id=obj.bot.id,
-                                                              status=bot_chat_member.status)
-            elif db_bot_chat_member and not bot_chat_member:
-                await chat_member_delete(Session,
-                                         chat_id=telegram_chat.id,
-                                         user_id=obj.bot.id)
-            else:
-                db_bot_chat_member = await chat_member_update(Session,
-                                                              chat_id=telegram_chat.id,
-                                                              user_id=obj.bot.id,
-                                                              status=bot_chat_member.status)
+            db_chat = dict(id=telegram_chat.id,
+                           title=telegram_chat.title,
+                           username=telegram_chat.username,
+                           type=telegram_chat.type)
+            for user_id, chat_member in ((telegram_user.id, telegram_chat_member), (obj.bot.id, bot_chat_member)):
+                if chat_member:
+                    members.append(dict(chat_id=telegram_chat.id, user_id=user_id, status=chat_member.status))
+                else:
+                    left_members.append((telegram_chat.id, user_id))
 
+        db_user, db_chat, db_chat_member = await telegram_state_upsert(Session,
+                                                                       user=db_user,
+                                                                       chat=db_chat,
+                                                                       members=members,
+                                                                       left_members=left_members)
+        sync_cache[sync_key] = (profile, (db_user, db_chat, db_chat_member))
         data['user'] = db_user
         data['chat'] = db_chat
         data['chat_member'] = db_chat_member
+        begin_read_cache(db_user, db_chat)
@@ -1,7 +1,21 @@
+import asyncio
+import calendar
 import datetime
 import decimal
 import math
-from typing import Union, Tuple
+import re
+from typing import Union, Tuple, Dict, Hashable, Callable, Awaitable, Any
+
+SPACES_RE = re.compile(' +')
+NEWLINES_RE = re.compile('\n+')
+COMMA_TO_SPACE = str.maketrans(',', ' ')
+# First and last month of the quarter, indexed by month number
+QUARTER_FIRST_MONTH = (None, 1, 1, 1, 4, 4, 4, 7, 7, 7, 10, 10, 10)
+QUARTER_LAST_MONTH = (None, 3, 3, 3, 6, 6, 6, 9, 9, 9, 12, 12, 12)
+# value_to_decimal quantizers for 0..16 decimal places
+QUANTIZERS = tuple(decimal.Decimal('1e-{}'.format(places)) for places in range(17))
+
+_in_flight: Dict[Hashable, asyncio.Future] = {}
 
 
 def first_day_of_month(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
@@ -9,12 +23,7 @@ def first_day_of_month(any_day: Union[datetime.datetime, datetime.date]) -> date
 
 
 def last_day_of_month(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
-    # this will never fail
-    # get close to the end of the month for any day, and add 4 days 'over'
-    next_month = any_day.replace(day=28) + datetime.timedelta(days=4)
-    # subtract the number of remaining 'overage' days to get last day of current month,
-    # or said programattically said, the previous day of the first of next month
-    return next_month - datetime.timedelta(days=next_month.day)
+    return any_day.replace(day=calendar.monthrange(any_day.year, any_day.month)[1])
 
 
 def first_day_of_week(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
@@ -40,13 +49,12 @@ def last_day_of_decade(any_day: Union[datetime.datetime, datetime.date]) -> date
 
 
 def first_day_of_quarter(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
-    quarter = (any_day.month - 1) // 3
-    return any_day.replace(month=1 + 3 * quarter, day=1)
+    return any_day.replace(month=QUARTER_FIRST_MONTH[any_day.month], day=1)
 
 
 def last_day_of_quarter(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
-    quarter = (any_day.month - 1) // 3
-    return last_day_of_month(any_day.replace(month=3 + 3 * quarter, day=1))
+    month = QUARTER_LAST_MONTH[any_day.month]
+    return any_day.replace(month=month, day=calendar.monthrange(any_day.year, month)[1])
 
 
 def first_day_of_half_year(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
@@ -57,33 +65,43 @@ def last_day_of_half_year(any_day: Union[datetime.datetime, datetime.date]) -> d
     return any_day.replace(month=6, day=30) if any_day.month < 6 else any_day.replace(month=12, day=31)
 
 
+def first_day_of_year(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
+    return any_day.replace(month=1, day=1)
+
+
+def last_day_of_year(any_day: Union[datetime.datetime, datetime.date]) -> datetime.date:
+    return any_day.replace(month=12, day=31)
+
+
+# Range code to (first day, last day) functions
+DATE_RANGES = {
+    'w': (first_day_of_week, last_day_of_week),
+    'd': (first_day_of_decade, last_day_of_decade),
+    'm': (first_day_of_month, last_day_of_month),
+    'q': (first_day_of_quarter, last_day_of_quarter),
+    'h': (first_day_of_half_year, last_day_of_half_year),
+    'y': (first_day_of_year, last_day_of_year),
+}
+
+
 def date_range(any_day: Union[datetime.datetime, datetime.date],
                range_code: str = 'w') -> Tuple[datetime.date, datetime.date]:
     if isinstance(any_day, datetime.datetime):
         any_day = any_day.date()
-    if range_code not in ['w', 'd', 'm', 'q', 'h', 'y']:
+    range_days = DATE_RANGES.get(range_code)
+    if not range_days:
         return any_day, any_day
-    if range_code == 'w':
-        return first_day_of_week(any_day), last_day_of_week(any_day)
-    if range_code == 'd':
-        return first_day_of_decade(any_day), last_day_of_decade(any_day)
-    if range_code == 'm':
-        return first_day_of_month(any_day), last_day_of_month(any_day)
-    if range_code == 'q':
-        return first_day_of_quarter(any_day), last_day_of_quarter(any_day)
-    if range_code == 'h':
-        return first_day_of_half_year(any_day), last_day_of_half_year(any_day)
-    if range_code == 'y':
-        return any_day.replace(month=1, day=1), any_day.replace(month=12, day=31)
+    first_day, last_day = range_days
+    return first_day(any_day), last_day(any_day)
 
 
 def remove_extra_spaces(text: str) -> str:
-    clean_text = ' '.join([t for t in text.split(' ') if t])
-    return "\n".join([t for t in clean_text.split('\n') if t])
+    clean_text = SPACES_RE.sub(' ', text).strip(' ')
+    return NEWLINES_RE.sub('\n', clean_text).strip('\n')
 
 
 def format_float(value: Union[int, float, decimal.Decimal], pre=4) -> str:
-    return f"{value:<+,.{pre}f}".replace(",", " ")
+    return f"{value:<+,.{pre}f}".translate(COMMA_TO_SPACE)
 
 
 def format_decimal(value: Union[int, float, decimal.Decimal], pre=8):
@@ -92,8 +110,11 @@ def format_decimal(value: Union[int, float, decimal.Decimal], pre=8):
 
 
 def value_to_decimal(value, decimal_places: int = 8) -> decimal.Decimal:
-    decimal.getcontext().rounding = decimal.ROUND_HALF_UP  # define rounding method
-    return decimal.Decimal(str(float(value))).quantize(decimal.Decimal('1e-{}'.format(decimal_places)))
+    quantizer = QUANTIZERS[decimal_places] if 0 <= decimal_places < len(QUANTIZERS) \
+        else decimal.Decimal('1e-{}'.format(decimal_places))
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(str(float(value)))
+    return value.quantize(quantizer, rounding=decimal.ROUND_HALF_UP)
 
 
 def size_human_read_format(size: Union[int, float]):
@@ -106,3 +127,15 @@ def size_human_read_format(size: Union[int, float]):
         return "0 B"
     pwr = math.floor(math.log(size, 1024))
     return f"{size / 1024 ** pwr:.2f} {suffixes[pwr]}"
+
+
+async def single_flight(key: Hashable, coro_fn: Callable[[], Awaitable]) -> Any:
+    """
+    Run coro_fn() once for all concurrent callers with the same key, they all get the same result
+    """
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(coro_fn())
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    return await asyncio.shield(future)
@@ -1,8 +1,11 @@
+import asyncio
 import logging
+from datetime import datetime, timezone
+from typing import List, Sequence, Optional
 
-from sqlalchemy import DateTime, Column, MetaData, func, event, types
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.future import Engine
+from sqlalchemy import DateTime, Column, MetaData, event, types, or_, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 from tgbot.config import Config
@@ -21,28 +24,117 @@ Base = declarative_base(metadata=meta)
 
 MAX_SQLITE_INT = 2 ** 63 - 1
 
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = (
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+)
+
+# Pass to every UPDATE and DELETE executed by a session: sessions are short and hold no objects to synchronize,
+# so their criteria must not be evaluated against the identity map
+BULK_DML_OPTIONS = {'synchronize_session': False}
+
 
 class VeryBigInt(types.TypeDecorator):
     impl = types.Integer
-    cache_ok = False
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        return hex(value) if value > MAX_SQLITE_INT else value
+        return value if value is None or value <= MAX_SQLITE_INT else hex(value)
 
     def process_result_value(self, value, dialect):
         return int(value, 16) if isinstance(value, str) else value
 
 
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
 class TimedBaseModel(Base):
     __abstract__ = True
 
-    __mapper_args__ = {"eager_defaults": True}
+    created_at = Column(DateTime(True), default=utc_now)
+    updated_at = Column(DateTime(True), default=utc_now, onupdate=utc_now)
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def dialect_insert(Session: sessionmaker, table):
+    """
+    Return INSERT construct of the session's database dialect, which supports ON CONFLICT clauses.
+
+    :param Session: DB session object
+    :param table: Mapped class or Table to insert into
+    :return: Dialect specific Insert object
+    """
+    if Session.kw['bind'].dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+
+def dialect_returning(Session: sessionmaker) -> bool:
+    """
+    Return True if the session's database dialect can return rows from INSERT and UPDATE statements.
+    """
+    return Session.kw['bind'].dialect.name == 'postgresql'
+
 
-    created_at = Column(DateTime(True), server_default=func.datetime('now', 'localtime'))
-    updated_at = Column(
-        DateTime(True), default=func.datetime('now', 'localtime'),
-        onupdate=func.datetime('now', 'localtime'),
-        server_default=func.datetime('now', 'localtime'))
+def distinct_from(table, values: dict):
+    """
+    Build condition which is true when at least one column of table differs from its value in values.
+
+    :param table: Mapped class
+    :param values: Dictionary of column names and values
+    :return: SQL expression
+    """
+    return or_(*(getattr(table, key).is_distinct_from(value) for key, value in values.items()))
+
+
+def upsert_changed(Session: sessionmaker, table, values: Optional[List[dict]], index_elements: Sequence[str],
+                   columns: Sequence[str]):
+    """
+    Build INSERT ... ON CONFLICT DO UPDATE statement which updates existing row only when
+    one of columns differs from inserted value, so unchanged rows are not rewritten.
+    updated_at is refreshed for TimedBaseModel tables.
+
+    :param Session: DB session object
+    :param table: Mapped class to insert into
+    :param values: List of dictionaries of table attributes, None to pass them to execute() as executemany parameters
+    :param index_elements: Primary key columns names
+    :param columns: Columns names to update
+    :return: Dialect specific Insert object
+    """
+    statement = dialect_insert(Session, table)
+    if values is not None:
+        statement = statement.values(values)
+    set_ = {key: statement.excluded[key] for key in columns}
+    if issubclass(table, TimedBaseModel):
+        set_['updated_at'] = utc_now()
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_=set_,
+        where=or_(*(getattr(table, key).is_distinct_from(statement.excluded[key]) for key in columns)))
+
+
+async def warm_up_pool(engine: AsyncEngine, size: int):
+    """
+    Open size pooled connections concurrently, so first updates do not wait for connection setup.
+    """
+
+    async def ping():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(ping() for _ in range(size)))
 
 
 async def create_db_session(config: Config) -> sessionmaker:
@@ -54,27 +146,41 @@ async def create_db_session(config: Config) -> sessionmaker:
         database_uri = f"{config.db.dialect}://{config.db.user}:{config.db.password}" \
                        f"@{config.db.host}/{config.db.database}"
 
+    if config.db.dialect.startswith('sqlite'):
+        # SQLite file databases use NullPool, which does not accept pool sizing arguments.
+        # timeout is how long a connection waits for a database lock held by another one
+        engine_kwargs = dict(
+            connect_args=dict(timeout=config.db.sqlite_timeout)
+        )
+    else:
+        engine_kwargs = dict(
+            pool_size=config.db.pool_size,
+            max_overflow=config.db.max_overflow,
+            pool_recycle=config.db.pool_recycle,
+            pool_pre_ping=config.db.pool_pre_ping
+        )
+
     engine = create_async_engine(
         database_uri,
         echo=config.db.echo,
-        future=True
+        future=True,
+        **engine_kwargs
     )
 
     if config.db.dialect.startswith('sqlite'):
-        @event.listens_for(Engine, "connect")
-        def set_sqlite_pragma(dbapi_connection, connection_record):
-            cursor = dbapi_connection.cursor()
-            cursor.execute("PRAGMA foreign_keys=ON")
-            cursor.close()
+        event.listen(engine.sync_engine, "connect", set_sqlite_pragma)
 
     async with engine.begin() as conn:
         # await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
 
+    if not config.db.dialect.startswith('sqlite'):
+        await warm_up_pool(engine, config.db.pool_size)
+
     Session: sessionmaker = sessionmaker(
         engine,
         expire_on_commit=False,
         class_=AsyncSession
     )
-    logger.info(f"Database {database_uri} session successfully configured")
+    logger.info("Database %s session successfully configured", database_uri)
     return Session
@@ -1,28 +1,59 @@
+import asyncio
 import logging
+from functools import lru_cache
 from ipaddress import ip_address
-from typing import Optional, List, Union
+from typing import Optional, List, AsyncIterator, Dict, Tuple
 
 from aiohttp import ClientSession
 from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, types, insert, select, update, delete, \
-    ForeignKeyConstraint
-from sqlalchemy.orm import relationship, sessionmaker
+    ForeignKeyConstraint, Index, lambda_stmt
+from sqlalchemy.orm import relationship, sessionmaker, noload
+from sqlalchemy.sql import Select
 from sqlalchemy.sql import expression
 
-from tgbot.models.base import Base
+from tgbot.models.base import Base, BULK_DML_OPTIONS, dialect_insert, upsert_changed
 from tgbot.services.outline_server_api import OutlineVPN, OutlineKey
 
 logger = logging.getLogger(__name__)
 
+SERVERS_STREAM_BUFFER = 50
+SERVER_KEY_SYNC_COLUMNS = ('name', 'password', 'port', 'method', 'access_url', 'used_bytes')
+# The same few server addresses are loaded with every row, address objects are immutable and safe to share
+cached_ip_address = lru_cache(maxsize=256)(ip_address)
+
+
+@lru_cache(maxsize=256)
+def cached_ip_int(ip: str) -> int:
+    return int(ip_address(ip))
+
+
+# Outline VPN API clients keyed by manage url and aiohttp session
+outline_clients: Dict[Tuple[str, ClientSession], OutlineVPN] = {}
+
+
+def get_outline_vpn(api_url: str, aiohttp_session: ClientSession) -> OutlineVPN:
+    vpn = outline_clients.get((api_url, aiohttp_session))
+    if vpn is None:
+        vpn = OutlineVPN(api_url=api_url, session=aiohttp_session, logger=logger)
+        outline_clients[(api_url, aiohttp_session)] = vpn
+    return vpn
+
 
 class IPAddressType(types.TypeDecorator):
     impl = types.Integer
     cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        return int(value) if value else None
+        if not value:
+            return None
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str):
+            return cached_ip_int(value)
+        return int(value)
 
     def process_result_value(self, value, dialect):
-        return ip_address(value) if value else None
+        return cached_ip_address(value) if value else None
 
 
 class OutlineServer(Base):
@@ -31,19 +62,23 @@ class OutlineServer(Base):
     ip = Column(IPAddressType, primary_key=True)
     url = Column(String(length=256), )
     name = Column(String(length=128), server_default="my server")
-    is_active = Column(Boolean, server_default=expression.true())
+    is_active = Column(Boolean, server_default=expression.true(), index=True)
     keys = relationship(
-        "ServerKey", cascade="all, delete-orphan", backref="server", lazy="joined"
+        "ServerKey", cascade="all, delete-orphan", backref="server", lazy="selectin"
     )
 
 
 class ServerKey(Base):
     __tablename__ = "server_key"
+    __table_args__ = (
+        # server_key_list orders keys of a server by name
+        Index("ix_server_key_server_ip_name", "server_ip", "name"),
+    )
 
     server_ip = Column(IPAddressType, ForeignKey("outline_server.ip", ondelete="RESTRICT", onupdate="CASCADE"),
                        primary_key=True)
     key_id = Column(Integer, primary_key=True)
-    name = Column(String(length=256), server_default="",  index=True)
+    name = Column(String(length=256), nullable=True)
     password = Column(String(length=256), nullable=True)
     port = Column(Integer, default=0)
     method = Column(String(length=256))
@@ -80,16 +115,21 @@ async def server_create(Session: sessionmaker, **kwargs) -> Optional[OutlineServ
 
     :param Session: DB session object
     :param kwargs: Contain dictionary of OutlineServer attributes
-    :return: OutlineServer object on success, None on failure
+    :return: OutlineServer object on success, None on failure or if server with such ip already exists
     """
     if not kwargs.get('ip', None) or not kwargs.get('url', None):
         return None
 
-    async with Session() as session:
-        statement = insert(OutlineServer).values(**kwargs)
-        await session.execute(statement)
-        await session.commit()
-    server: OutlineServer = await server_read(Session, ip=kwargs['ip'])
+    # session.begin() commits on leaving the block, nothing is written when the server already exists
+    async with Session() as session, session.begin():
+        statement = dialect_insert(Session, OutlineServer).values(**kwargs).on_conflict_do_nothing(
+            index_elements=['ip'])
+        result = await session.execute(statement)
+        if not result.rowcount:
+            logger.warning("Outline server %s already exists", kwargs['ip'])
+            return None
+        result = await session.execute(select(OutlineServer).where(OutlineServer.ip == kwargs['ip']))
+        server: OutlineServer = result.scalar()
     return server
 
 
@@ -106,8 +146,28 @@ async def server_read(Session: sessionmaker, **kwargs) -> Optional[OutlineServer
     if not kwargs.get('ip', None):
         return None
 
+    ip = kwargs['ip']
+    async with Session() as session:
+        statement = lambda_stmt(lambda: select(OutlineServer).where(OutlineServer.ip == ip))
+        result = await session.execute(statement)
+        return result.scalar()
+
+
+async def server_read_url(Session: sessionmaker, **kwargs) -> Optional[str]:
+    """
+    Read only manage url of OutlineServer from database. kwargs must have the following attributes:
+
+        *ip  ip_address from ipaddress library IP address of the server
+
+    :param Session: DB session object
+    :param kwargs: Contain dictionary of OutlineServer attributes
+    :return: Outline server manage url on success, None on failure
+    """
+    if not kwargs.get('ip', None):
+        return None
+
     async with Session() as session:
-        statement = select(OutlineServer).where(OutlineServer.ip == kwargs['ip'])
+        statement = select(OutlineServer.url).where(OutlineServer.ip == kwargs['ip'])
         result = await session.execute(statement)
         return result.scalar()
 
@@ -133,11 +193,11 @@ async def server_update(Session: sessionmaker, **kwargs) -> Optional[OutlineServ
     if not kwargs.get('primary_key_ip', None):
         return None
     primary_key_ip = kwargs.pop('primary_key_ip')
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = update(OutlineServer).where(OutlineServer.ip == primary_key_ip).values(**kwargs)
-        await session.execute(statement)
-        await session.commit()
-    server: OutlineServer = await server_read(Session, ip=kwargs.get('ip', primary_key_ip))
+        await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        result = await session.execute(select(OutlineServer).where(OutlineServer.ip == kwargs.get('ip', primary_key_ip)))
+        server: OutlineServer = result.scalar()
     return server
 
 
@@ -154,11 +214,23 @@ async def server_delete(Session: sessionmaker, **kwargs) -> bool:
     if not kwargs.get('ip', None):
         return False
 
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = delete(OutlineServer).where(OutlineServer.ip == kwargs['ip'])
-        result = await session.execute(statement)
-        await session.commit()
-        return True if result.rowcount else False
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    return True if result.rowcount else False
+
+
+def servers_list_statement(mode: Optional[str] = None) -> Select:
+    """
+    Build select statement for servers_list and servers_stream, mode is the same as for servers_list.
+    """
+    mode = 'all' if not mode else mode
+    statement = select(OutlineServer)
+    if mode == 'active':
+        statement = statement.where(OutlineServer.is_active == expression.true())
+    elif mode == 'inactive':
+        statement = statement.where(OutlineServer.is_active == expression.false())
+    return statement
 
 
 async def servers_list(Session: sessionmaker, **kwargs) -> List[OutlineServer]:
@@ -167,25 +239,36 @@ async def servers_list(Session: sessionmaker, **kwargs) -> List[OutlineServer]:
 
         *mode may have one of three value 'all', 'active', 'inactive'. When pass 'all' is_active attribute ignored.
                 When pass 'active' method will return rows with is_active==True.
-                When pass 'nonactive' method will return rows with is_active==False.
+                When pass 'inactive' method will return rows with is_active==False.
 
     :param Session: DB session object
     :param kwargs: Contain dictionary of OutlineServer attributes
     :return: List of vpn servers
     """
-    mode = 'all' if not kwargs.get('mode', None) else kwargs['mode']
-    statement = select(OutlineServer)
-    if mode == 'active':
-        statement = statement.where(OutlineServer.is_active is True)
-    elif mode == 'inactive':
-        statement = statement.where(OutlineServer.is_active is False)
+    statement = servers_list_statement(kwargs.get('mode', None))
     async with Session() as session:
         result = await session.execute(statement)
-        return result.unique().scalars().all()
+        return result.scalars().all()
+
+
+async def servers_stream(Session: sessionmaker, **kwargs) -> AsyncIterator[OutlineServer]:
+    """
+    Stream OutlineServer objects from database with a server-side cursor, without loading their keys.
+    kwargs are the same as for servers_list.
+
+    :param Session: DB session object
+    :param kwargs: Contain dictionary of OutlineServer attributes
+    :return: Async iterator of vpn servers
+    """
+    statement = servers_list_statement(kwargs.get('mode', None)).options(noload(OutlineServer.keys))
+    async with Session() as session:
+        result = await session.stream_scalars(statement.execution_options(max_row_buffer=SERVERS_STREAM_BUFFER))
+        async for server in result:
+            yield server
 
 
 async def server_key_create(Session: sessionmaker,
-                            aiohttp_session: Optional[ClientSession],
+                            aiohttp_session: ClientSession,
                             **kwargs) -> Optional[ServerKey]:
     """
     Create Outline server key on outline server and then in database. kwargs must have the following attributes:
@@ -200,30 +283,31 @@ async def server_key_create(Session: sessionmaker,
     """
     if not kwargs.get('server_ip', None):
         return None
-    vpn = OutlineVPN(session=aiohttp_session, logger=logger)
-    async with Session() as session:
-        server = await server_read(Session, ip=kwargs['server_ip'])
-        if not server:
-            return
-        vpn.api_url = server.url
-        key: OutlineKey = await vpn.create_key()
-        if key and kwargs.get('key_name', None):
-            if await vpn.rename_key(key.key_id, kwargs['key_name']):
-                key = OutlineKey(key_id=key.key_id,
-                                 name=kwargs['key_name'],
-                                 password=key.password,
-                                 port=key.port,
-                                 method=key.method,
-                                 access_url=key.access_url,
-                                 used_bytes=key.used_bytes)
-        statement = insert(ServerKey).values(server_ip=kwargs['server_ip'], key_id=key.key_id,
-                                             name=key.name, password=key.password,
-                                             port=key.port, method=key.method,
-                                             access_url=key.access_url, used_bytes=key.used_bytes)
-        await session.execute(statement)
-        await session.commit()
-    server_key: ServerKey = await server_key_read(Session, server_ip=kwargs['server_ip'], key_id=key.key_id)
-    return server_key
+    server_url = await server_read_url(Session, ip=kwargs['server_ip'])
+    if not server_url:
+        return None
+    vpn = get_outline_vpn(server_url, aiohttp_session)
+    key: OutlineKey = await vpn.create_key()
+    if not key:
+        return None
+    if kwargs.get('key_name', None):
+        if await vpn.rename_key(key.key_id, kwargs['key_name']):
+            key = OutlineKey(key_id=key.key_id,
+                             name=kwargs['key_name'],
+                             password=key.password,
+                             port=key.port,
+                             method=key.method,
+                             access_url=key.access_url,
+                             used_bytes=key.used_bytes)
+    values = dict(server_ip=kwargs['server_ip'], key_id=key.key_id,
+                  name=key.name, password=key.password,
+                  port=key.port, method=key.method,
+                  access_url=key.access_url, used_bytes=key.used_bytes)
+    # Database session is opened only after Outline API calls, so it is short
+    async with Session() as session, session.begin():
+        await session.execute(insert(ServerKey).values(**values))
+    # All columns are known, so the stored key is not read back
+    return ServerKey(**values)
 
 
 async def server_key_read(Session: sessionmaker, **kwargs) -> Optional[ServerKey]:
@@ -239,9 +323,30 @@ async def server_key_read(Session: sessionmaker, **kwargs) -> Optional[ServerKey
     """
     if not kwargs.get('server_ip', None) or kwargs.get('key_id', None) is None:
         return None
+    server_ip, key_id = kwargs['server_ip'], kwargs['key_id']
     async with Session() as session:
-        statement = select(ServerKey).where(ServerKey.server_ip == kwargs['server_ip'],
-                                            ServerKey.key_id == kwargs['key_id'])
+        statement = lambda_stmt(lambda: select(ServerKey).where(ServerKey.server_ip == server_ip,
+                                                                ServerKey.key_id == key_id))
+        result = await session.execute(statement)
+        return result.scalar()
+
+
+async def server_key_read_access_url(Session: sessionmaker, **kwargs) -> Optional[str]:
+    """
+    Read only access url of Outline server key from database. kwargs must have the following attributes:
+
+        *server_ip  ip_address from ipaddress library IP address of the server.
+        *key_id key id
+
+    :param Session: DB session object
+    :param kwargs: Contain dictionary of ServerKey attributes
+    :return: Access url on success, None on failure
+    """
+    if not kwargs.get('server_ip', None) or kwargs.get('key_id', None) is None:
+        return None
+    async with Session() as session:
+        statement = select(ServerKey.access_url).where(ServerKey.server_ip == kwargs['server_ip'],
+                                                       ServerKey.key_id == kwargs['key_id'])
         result = await session.execute(statement)
         return result.scalar()
 
@@ -261,44 +366,49 @@ async def server_key_update(Session: sessionmaker, **kwargs) -> Optional[ServerK
         return None
     server_ip = kwargs.pop('server_ip')
     key_id = kwargs.pop('key_id')
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = update(ServerKey).where(ServerKey.server_ip == server_ip,
                                             ServerKey.key_id == key_id).values(**kwargs)
-        await session.execute(statement)
-        await session.commit()
-    server_key: ServerKey = await server_key_read(Session, server_ip=server_ip, key_id=key_id)
+        await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        statement = select(ServerKey).where(ServerKey.server_ip == server_ip, ServerKey.key_id == key_id)
+        result = await session.execute(statement)
+        server_key: ServerKey = result.scalar()
     return server_key
 
 
 async def server_key_delete(Session: sessionmaker,
-                            aiohttp_session: Optional[ClientSession],
-                            **kwargs) -> bool:
+                            aiohttp_session: ClientSession,
+                            **kwargs) -> Optional[List[ServerKey]]:
     """
-    Create Outline server key on outline server and then in database. kwargs must have the following attributes:
+    Delete Outline server key on outline server and then in database. kwargs must have the following attributes:
 
         *server_ip  ip_address from ipaddress library IP address of the server.
-        *key_name name of the key
+        *key_id key id
 
     :param Session: DB session object
     :param aiohttp_session: aiohttp session
     :param kwargs: Contain dictionary of ServerKey attributes
-    :return: True on success, False on failure
+    :return: List of remaining server keys on success, None on failure
     """
     if not kwargs.get('server_ip', None) and not kwargs.get('key_id', None):
-        return False
-    vpn = OutlineVPN(session=aiohttp_session, logger=logger)
-    async with Session() as session:
-        server = await server_read(Session, ip=kwargs['server_ip'])
-        if not server:
-            return False
-        vpn.api_url = server.url
-        if not await vpn.delete_key(key_id=kwargs['key_id']):
-            return False
+        return None
+    server_url = await server_read_url(Session, ip=kwargs['server_ip'])
+    if not server_url:
+        return None
+    vpn = get_outline_vpn(server_url, aiohttp_session)
+    if not await vpn.delete_key(key_id=kwargs['key_id']):
+        return None
+    async with Session() as session, session.begin():
         statement = delete(ServerKey).where(ServerKey.server_ip == kwargs['server_ip'],
                                             ServerKey.key_id == kwargs['key_id'])
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        if not result.rowcount:
+            return None
+        statement = select(ServerKey).where(ServerKey.server_ip == kwargs['server_ip']) \
+            .order_by(ServerKey.name.nullsfirst())
         result = await session.execute(statement)
-        await session.commit()
-        return True if result.rowcount else False
+        server_keys = result.scalars().all()
+    return server_keys
 
 
 async def server_key_list(Session: sessionmaker, **kwargs) -> List[ServerKey]:
@@ -313,84 +423,80 @@ async def server_key_list(Session: sessionmaker, **kwargs) -> List[ServerKey]:
     """
     if not kwargs.get('server_ip', None):
         return []
-    statement = select(ServerKey).where(ServerKey.server_ip == kwargs['server_ip']).order_by(ServerKey.name)
+    server_ip = kwargs['server_ip']
+    statement = lambda_stmt(lambda: select(ServerKey).where(ServerKey.server_ip == server_ip)
+                            .order_by(ServerKey.name.nullsfirst()))
     async with Session() as session:
         result = await session.execute(statement)
-        return result.unique().scalars().all()
+        return result.scalars().all()
 
 
 async def server_key_sync(Session: sessionmaker,
-                          aiohttp_session: Optional[ClientSession],
-                          **kwargs) -> Union[bool, Optional[List[ServerKey]]]:
+                          aiohttp_session: ClientSession,
+                          **kwargs) -> Tuple[List[ServerKey], bool]:
     """
     Sync ServerKey objects from database with Outline VPN Server. kwargs may have the following attributes:
+    Database sessions are short and opened around queries only, no pooled connection is held while
+    Outline VPN Server API is requested, so concurrent syncs are limited by DB pool size only for query time.
 
         *server_ip  ip_address from ipaddress library IP address of the server.
 
     :param Session: DB session object
     :param aiohttp_session: aiohttp session
     :param kwargs: Contain dictionary of OutlineServer attributes
-    :return: True on success, False on failure
+    :return: Tuple of list of server keys ordered by name and True if sync succeeded,
+             keys stored in database and False if Outline VPN Server is unavailable
     """
     if not kwargs.get('server_ip', None):
-        return False
+        return [], False
     server_ip = kwargs['server_ip']
-    server = await server_read(Session, ip=server_ip)
-    if not server:
-        return False
+    server_url = await server_read_url(Session, ip=server_ip)
+    if not server_url:
+        return [], False
     try:
-        vpn = OutlineVPN(api_url=server.url, session=aiohttp_session, logger=logger)
-        vpn_keys = await vpn.get_keys()
-        key_list = await server_key_list(Session, server_ip=server_ip)
-        db_keys = [OutlineKey(key_id=key.key_id,
-                              name=key.name,
-                              password=key.password,
-                              port=key.port,
-                              method=key.method,
-                              access_url=key.access_url,
-                              used_bytes=key.used_bytes) for key in key_list]
-        db_key_id_list = [key.key_id for key in db_keys]
-        vpn_key_id_list = [key.key_id for key in vpn_keys]
-        # In case if we add key in OutlineManager
-        insert_values = [{'server_ip': server_ip,
+        vpn = get_outline_vpn(server_url, aiohttp_session)
+        vpn_keys, key_list = await asyncio.gather(vpn.get_keys(), server_key_list(Session, server_ip=server_ip))
+        vpn_keys_by_id = {key.key_id: key for key in vpn_keys}
+        db_keys_by_id = {key.key_id: OutlineKey(key_id=key.key_id,
+                                                name=key.name,
+                                                password=key.password,
+                                                port=key.port,
+                                                method=key.method,
+                                                access_url=key.access_url,
+                                                used_bytes=key.used_bytes) for key in key_list}
+        # In case if we add key in OutlineManager or need update key from OutlineVPN
+        upsert_values = [{'server_ip': server_ip,
                           'key_id': key.key_id,
                           'name': key.name,
                           'password': key.password,
                           'port': key.port,
                           'method': key.method,
                           'access_url': key.access_url,
-                          'used_bytes': key.used_bytes} for key in
-                         set(filter(lambda k: k.key_id not in db_key_id_list, vpn_keys))]
+                          'used_bytes': key.used_bytes} for key_id, key in vpn_keys_by_id.items()
+                         if db_keys_by_id.get(key_id) != key]
 
         # In case if we delete key in OutlineManager
-        keys_to_delete = set(filter(lambda k: k.key_id not in vpn_key_id_list, db_keys))
-        # In case if we add need update key from OutlineVPN
-        keys_to_update = set(vpn_keys) - set(keys_to_delete) - set(db_keys)
-        # keys_not_in_db = set(vpn_keys) - set(db_keys)
-        # In case if we remove key in OutlineManager
-        async with Session() as session:
-            if len(insert_values):
-                statement = insert(ServerKey).values(insert_values)
-                await session.execute(statement)
-
-            for key in keys_to_delete:
+        key_ids_to_delete = list(db_keys_by_id.keys() - vpn_keys_by_id.keys())
+        if not upsert_values and not key_ids_to_delete:
+            logger.debug("Keys of server %s are already in sync", server_ip)
+            return key_list, True
+        async with Session() as session, session.begin():
+            if len(upsert_values):
+                # executemany keeps one compiled statement whatever the number of changed keys is
+                statement = upsert_changed(Session, ServerKey, None, ['server_ip', 'key_id'], SERVER_KEY_SYNC_COLUMNS)
+                await session.execute(statement, upsert_values)
+
+            if key_ids_to_delete:
                 statement = delete(ServerKey).where(ServerKey.server_ip == server_ip,
-                                                    ServerKey.key_id == key.key_id)
-                result = await session.execute(statement)
-            for key in keys_to_update:
-                statement = update(ServerKey).where(ServerKey.server_ip == server_ip,
-                                                    ServerKey.key_id == key.key_id
-                                                    ).values({'name': key.name,
-                                                              'password': key.password,
-                                                              'port': key.port,
-                                                              'method': key.method,
-                                                              'access_url': key.access_url,
-                                                              'used_bytes': key.used_bytes})
-                await session.execute(statement)
-
-            await session.commit()
-            logger.info("Sync successful!")
+                                                    ServerKey.key_id.in_(key_ids_to_delete))
+                await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+
+        logger.info("Sync successful!")
     except Exception as e:
         logger.error("Error occurred during syncing. Error: %r", e)
-    finally:
-        return await server_key_list(Session, **kwargs)
+        return await server_key_list(Session, server_ip=server_ip), False
+    # Database keys are equal to Outline VPN Server keys now, no need to read them back.
+    # Same order as server_key_list: unnamed keys first, then by name
+    return sorted((ServerKey(server_ip=server_ip, **{column: getattr(key, column)
+                                                     for column in ('key_id',) + SERVER_KEY_SYNC_COLUMNS})
+                   for key in vpn_keys), key=lambda key: (key.name is not None, key.name or '')), True
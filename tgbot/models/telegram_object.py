@@ -1,12 +1,14 @@
-from typing import Optional
+from contextvars import ContextVar
+from typing import Optional, List, Tuple, Dict, Iterable
 
-from sqlalchemy import Column, Integer, Boolean, ForeignKey, String, insert, update, delete
+from sqlalchemy import Column, Integer, Boolean, ForeignKey, String, Index, insert, update, delete, tuple_, lambda_stmt
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.future import select
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.sql import expression
+from sqlalchemy.sql.lambdas import StatementLambdaElement
 
-from tgbot.models.base import TimedBaseModel
+from tgbot.models.base import TimedBaseModel, BULK_DML_OPTIONS, dialect_returning, distinct_from, upsert_changed
 
 
 class User(TimedBaseModel):
@@ -23,7 +25,7 @@ class User(TimedBaseModel):
     is_superuser = Column(Boolean, server_default=expression.false())
 
     user_chats = relationship(
-        "ChatMember", cascade="all, delete-orphan", backref="user_chat", lazy="joined"
+        "ChatMember", cascade="all, delete-orphan", back_populates="user", lazy="raise"
     )
     chats = association_proxy("user_chats", "chat")
 
@@ -47,7 +49,7 @@ class Chat(TimedBaseModel):
     title = Column(String(length=128), nullable=True)
     username = Column(String(length=128), nullable=True)
     chat_users = relationship(
-        "ChatMember", cascade="all, delete-orphan", backref="chat_user", lazy="joined"
+        "ChatMember", cascade="all, delete-orphan", back_populates="chat", lazy="raise"
     )
     users = association_proxy("chat_users", "user")
 
@@ -64,18 +66,71 @@ class ChatRelatedMixin:
 
 class ChatMember(TimedBaseModel):
     __tablename__ = "chat_member"
+    # Primary key serves lookups by chat, this index serves lookups of user's chats
+    __table_args__ = (Index("ix_chat_member_user_chat", "user_id", "chat_id"),)
     chat_id = Column(Integer, ForeignKey("chat.id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
     user_id = Column(Integer, ForeignKey("user.id", ondelete="CASCADE", onupdate="CASCADE"), primary_key=True)
     status = Column(String(length=32))
 
-    chat = relationship("Chat", viewonly=True, lazy="joined")
-    user = relationship("User", viewonly=True, lazy="joined")
+    chat = relationship("Chat", back_populates="chat_users", lazy="raise")
+    user = relationship("User", back_populates="user_chats", lazy="raise")
 
     def __init__(self, chat, user, status='member'):
         self.chat = chat
         self.status = status
 
 
+# Column names of tables, other keys of kwargs are dropped before they reach INSERT or UPDATE
+USER_COLUMNS = frozenset(column.name for column in User.__table__.columns)
+CHAT_COLUMNS = frozenset(column.name for column in Chat.__table__.columns)
+CHAT_MEMBER_COLUMNS = frozenset(column.name for column in ChatMember.__table__.columns)
+
+
+def select_user(user_id: int) -> StatementLambdaElement:
+    """
+    Build cached SELECT of User by id, it is compiled once for all calls.
+    """
+    return lambda_stmt(lambda: select(User).where(User.id == user_id))
+
+
+def select_chat(chat_id: int) -> StatementLambdaElement:
+    """
+    Build cached SELECT of Chat by id, it is compiled once for all calls.
+    """
+    return lambda_stmt(lambda: select(Chat).where(Chat.id == chat_id))
+
+
+def select_chat_member(chat_id: int, user_id: int) -> StatementLambdaElement:
+    """
+    Build cached SELECT of ChatMember by primary key, it is compiled once for all calls.
+    """
+    return lambda_stmt(lambda: select(ChatMember).where(ChatMember.chat_id == chat_id,
+                                                        ChatMember.user_id == user_id))
+
+
+# Users and chats read during the current update, DBMiddleware starts them for every update
+user_read_cache: ContextVar[Optional[Dict[int, User]]] = ContextVar('user_read_cache', default=None)
+chat_read_cache: ContextVar[Optional[Dict[int, Chat]]] = ContextVar('chat_read_cache', default=None)
+
+
+def begin_read_cache(user: Optional[User] = None, chat: Optional[Chat] = None) -> None:
+    """
+    Start caching user_read and chat_read results for the current update, seeded with already known objects.
+    """
+    user_read_cache.set({user.id: user} if user else {})
+    chat_read_cache.set({chat.id: chat} if chat else {})
+
+
+def forget_cached(cache: ContextVar, ids: Iterable[int]) -> None:
+    """
+    Drop objects changed in database from the read cache of the current update.
+    """
+    cached = cache.get()
+    if cached:
+        for id_ in ids:
+            cached.pop(id_, None)
+
+
 async def user_create(Session: sessionmaker, **kwargs) -> Optional[User]:
     """
     Create a new telegram User object in database. kwargs may have the following attributes:
@@ -99,17 +154,65 @@ async def user_create(Session: sessionmaker, **kwargs) -> Optional[User]:
     :param kwargs: Contain dictionary of User attributes
     :return: User object on success, None on failure
     """
+    kwargs = {key: value for key, value in kwargs.items() if key in USER_COLUMNS}
     if not kwargs.get('id', None) or not kwargs.get('first_name', None):
         return None
 
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = insert(User).values(**kwargs)
+        if dialect_returning(Session):
+            statement = select(User).from_statement(statement.returning(User))
+            result = await session.execute(statement)
+        else:
+            await session.execute(statement)
+            result = await session.execute(select_user(kwargs['id']))
+        user: User = result.scalar()
+    forget_cached(user_read_cache, [kwargs['id']])
+    return user
+
+
+async def user_upsert(Session: sessionmaker, **kwargs) -> Optional[User]:
+    """
+    Create a new telegram User object in database or update the existing one, with a single
+    INSERT ... ON CONFLICT DO UPDATE statement, use it instead of user_create followed by user_update.
+    kwargs are the same as for user_create, role is only used for a new user.
+
+    :param Session: DB session object
+    :param kwargs: Contain dictionary of User attributes
+    :return: User object on success, None on failure
+    """
+    kwargs = {key: value for key, value in kwargs.items() if key in USER_COLUMNS}
+    if not kwargs.get('id', None) or not kwargs.get('first_name', None):
+        return None
+
+    async with Session() as session, session.begin():
+        statement = upsert_changed(Session, User, [kwargs], ['id'], [key for key in kwargs if key not in ('id', 'role')])
         await session.execute(statement)
-        await session.commit()
-    user: User = await user_read(Session, id=kwargs['id'])
+        result = await session.execute(select_user(kwargs['id']))
+        user: User = result.scalar()
+    forget_cached(user_read_cache, [kwargs['id']])
     return user
 
 
+async def user_upsert_many(Session: sessionmaker, values: List[dict]) -> None:
+    """
+    Create or update several telegram User objects in database with a single executemany
+    INSERT ... ON CONFLICT DO UPDATE statement. All items of values must have the same keys,
+    id and first_name are mandatory (see user_create), role is only used for a new user.
+
+    :param Session: DB session object
+    :param values: List of dictionaries of User attributes
+    """
+    if not values:
+        return
+
+    columns = [key for key in values[0] if key not in ('id', 'role')]
+    async with Session() as session, session.begin():
+        statement = upsert_changed(Session, User, None, ['id'], columns)
+        await session.execute(statement, values)
+    forget_cached(user_read_cache, (item['id'] for item in values))
+
+
 async def user_read(Session: sessionmaker, **kwargs) -> Optional[User]:
     """
     Read telegram User object from database. kwargs must have the following attribute:
@@ -124,10 +227,16 @@ async def user_read(Session: sessionmaker, **kwargs) -> Optional[User]:
     if not kwargs.get('id', None):
         return None
 
+    cache = user_read_cache.get()
+    if cache is not None and kwargs['id'] in cache:
+        return cache[kwargs['id']]
     async with Session() as session:
-        statement = select(User).where(User.id == kwargs['id'])
+        statement = select_user(kwargs['id'])
         result = await session.execute(statement)
-        return result.scalar()
+        user: User = result.scalar()
+    if cache is not None and user:
+        cache[user.id] = user
+    return user
 
 
 async def user_update(Session: sessionmaker, **kwargs) -> Optional[User]:
@@ -152,14 +261,20 @@ async def user_update(Session: sessionmaker, **kwargs) -> Optional[User]:
     :param kwargs:  Contain dictionary of User attributes
     :return: User object on success, None on failure
     """
+    kwargs = {key: value for key, value in kwargs.items() if key in USER_COLUMNS}
     if not kwargs.get('id', None):
         return None
 
-    async with Session() as session:
-        statement = update(User).where(User.id == kwargs['id']).values(**kwargs)
-        await session.execute(statement)
-        await session.commit()
-    user: User = await user_read(Session, id=kwargs['id'])
+    changes = {key: value for key, value in kwargs.items() if key != 'id'}
+    if not changes:
+        return await user_read(Session, id=kwargs['id'])
+    async with Session() as session, session.begin():
+        # Row is not rewritten when no column differs
+        statement = update(User).where(User.id == kwargs['id'], distinct_from(User, changes)).values(**changes)
+        await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        result = await session.execute(select_user(kwargs['id']))
+        user: User = result.scalar()
+    forget_cached(user_read_cache, [kwargs['id']])
     return user
 
 
@@ -178,11 +293,28 @@ async def user_delete(Session: sessionmaker, **kwargs) -> bool:
     if not kwargs.get('id', None):
         return False
 
-    async with Session() as session:
+    forget_cached(user_read_cache, [kwargs['id']])
+    async with Session() as session, session.begin():
         statement = delete(User).where(User.id == kwargs['id'])
-        result = await session.execute(statement)
-        await session.commit()
-        return True if result.rowcount else False
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    return True if result.rowcount else False
+
+
+async def user_delete_many(Session: sessionmaker, ids: List[int]) -> int:
+    """
+    Delete several telegram User objects from database with a single DELETE statement.
+
+    :param Session: DB session object
+    :param ids: List of users ids
+    :return: Number of deleted rows
+    """
+    if not ids:
+        return 0
+
+    forget_cached(user_read_cache, ids)
+    async with Session() as session, session.begin():
+        result = await session.execute(delete(User).where(User.id.in_(ids)), execution_options=BULK_DML_OPTIONS)
+    return result.rowcount
 
 
 async def chat_create(Session: sessionmaker, **kwargs) -> Optional[Chat]:
@@ -202,15 +334,40 @@ async def chat_create(Session: sessionmaker, **kwargs) -> Optional[Chat]:
     :param kwargs: Contain dictionary of Chat attributes
     :return: Chat object on success, None on failure
     """
+    kwargs = {key: value for key, value in kwargs.items() if key in CHAT_COLUMNS}
     if not kwargs.get('id', None) or not kwargs.get('type', None):
         return None
 
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = insert(Chat).values(**kwargs)
-        result = await session.execute(statement)
-        await session.commit()
-        chat: Chat = await chat_read(Session, id=kwargs['id'])
-        return chat
+        if dialect_returning(Session):
+            statement = select(Chat).from_statement(statement.returning(Chat))
+            result = await session.execute(statement)
+        else:
+            await session.execute(statement)
+            result = await session.execute(select_chat(kwargs['id']))
+        chat: Chat = result.scalar()
+    forget_cached(chat_read_cache, [kwargs['id']])
+    return chat
+
+
+async def chat_upsert_many(Session: sessionmaker, values: List[dict]) -> None:
+    """
+    Create or update several telegram Chat objects in database with a single executemany
+    INSERT ... ON CONFLICT DO UPDATE statement. All items of values must have the same keys,
+    id and type are mandatory (see chat_create).
+
+    :param Session: DB session object
+    :param values: List of dictionaries of Chat attributes
+    """
+    if not values:
+        return
+
+    columns = [key for key in values[0] if key != 'id']
+    async with Session() as session, session.begin():
+        statement = upsert_changed(Session, Chat, None, ['id'], columns)
+        await session.execute(statement, values)
+    forget_cached(chat_read_cache, (item['id'] for item in values))
 
 
 async def chat_read(Session: sessionmaker, **kwargs) -> Optional[Chat]:
@@ -228,11 +385,16 @@ async def chat_read(Session: sessionmaker, **kwargs) -> Optional[Chat]:
     if not kwargs.get('id', None):
         return None
 
+    cache = chat_read_cache.get()
+    if cache is not None and kwargs['id'] in cache:
+        return cache[kwargs['id']]
     async with Session() as session:
-        statement = select(Chat).where(Chat.id == kwargs['id'])
+        statement = select_chat(kwargs['id'])
         result = await session.execute(statement)
-        chat = result.scalar()
-        return chat
+        chat: Chat = result.scalar()
+    if cache is not None and chat:
+        cache[chat.id] = chat
+    return chat
 
 
 async def chat_update(Session: sessionmaker, **kwargs) -> Optional[Chat]:
@@ -252,15 +414,21 @@ async def chat_update(Session: sessionmaker, **kwargs) -> Optional[Chat]:
     :param kwargs: Contain dictionary of Chat attributes
     :return: Chat object on success, None on failure
     """
+    kwargs = {key: value for key, value in kwargs.items() if key in CHAT_COLUMNS}
     if not kwargs.get('id', None):
         return None
 
-    async with Session() as session:
-        statement = update(Chat).where(Chat.id == kwargs['id']).values(**kwargs)
-        result = await session.execute(statement)
-        await session.commit()
-        chat: Chat = await chat_read(Session, id=kwargs['id'])
-        return chat
+    changes = {key: value for key, value in kwargs.items() if key != 'id'}
+    if not changes:
+        return await chat_read(Session, id=kwargs['id'])
+    async with Session() as session, session.begin():
+        # Row is not rewritten when no column differs
+        statement = update(Chat).where(Chat.id == kwargs['id'], distinct_from(Chat, changes)).values(**changes)
+        await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        result = await session.execute(select_chat(kwargs['id']))
+        chat: Chat = result.scalar()
+    forget_cached(chat_read_cache, [kwargs['id']])
+    return chat
 
 
 async def chat_delete(Session: sessionmaker, **kwargs) -> bool:
@@ -278,12 +446,28 @@ async def chat_delete(Session: sessionmaker, **kwargs) -> bool:
     if not kwargs.get('id', None):
         return False
 
-    async with Session() as session:
+    forget_cached(chat_read_cache, [kwargs['id']])
+    async with Session() as session, session.begin():
         statement = delete(Chat).where(Chat.id == kwargs['id'])
-        result = await session.execute(statement)
-        await session.commit()
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    return True if result.rowcount else False
+
+
+async def chat_delete_many(Session: sessionmaker, ids: List[int]) -> int:
+    """
+    Delete several telegram Chat objects from database with a single DELETE statement.
 
-        return True if result.rowcount else False
+    :param Session: DB session object
+    :param ids: List of chats ids
+    :return: Number of deleted rows
+    """
+    if not ids:
+        return 0
+
+    forget_cached(chat_read_cache, ids)
+    async with Session() as session, session.begin():
+        result = await session.execute(delete(Chat).where(Chat.id.in_(ids)), execution_options=BULK_DML_OPTIONS)
+    return result.rowcount
 
 
 async def chat_member_create(Session: sessionmaker, **kwargs) -> Optional[tuple]:
@@ -303,17 +487,17 @@ async def chat_member_create(Session: sessionmaker, **kwargs) -> Optional[tuple]
     :param kwargs: Contain dictionary of ChatMember attributes
     :return: ChatMember object on success, None on failure
     """
-
+    kwargs = {key: value for key, value in kwargs.items() if key in CHAT_MEMBER_COLUMNS}
     if not (kwargs.get('chat_id', None) and kwargs.get('user_id', None)) or not (kwargs.get('status', None)):
         return None
 
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = insert(ChatMember).values(**kwargs)
+        await session.execute(statement)
+        statement = select_chat_member(kwargs['chat_id'], kwargs['user_id'])
         result = await session.execute(statement)
-        await session.commit()
-        chat_member: ChatMember = await chat_member_read(Session, chat_id=kwargs['chat_id'],
-                                                         user_id=kwargs['user_id'])
-        return chat_member
+        chat_member: ChatMember = result.scalar()
+    return chat_member
 
 
 async def chat_member_read(Session: sessionmaker, **kwargs) -> Optional[ChatMember]:
@@ -335,13 +519,63 @@ async def chat_member_read(Session: sessionmaker, **kwargs) -> Optional[ChatMemb
         return None
 
     async with Session() as session:
-        statement = select(ChatMember).where(ChatMember.chat_id == kwargs['chat_id'],
-                                             ChatMember.user_id == kwargs['user_id'])
+        statement = select_chat_member(kwargs['chat_id'], kwargs['user_id'])
         result = await session.execute(statement)
         chat_member: ChatMember = result.scalar()
         return chat_member
 
 
+async def chat_member_create_many(Session: sessionmaker, values: List[dict]) -> int:
+    """
+    Create several telegram ChatMember objects in database with a single INSERT statement.
+    Each item of values must have chat_id, user_id and status keys (see chat_member_create).
+
+    :param Session: DB session object
+    :param values: List of dictionaries of ChatMember attributes
+    :return: Number of inserted rows
+    """
+    if not values:
+        return 0
+
+    async with Session() as session, session.begin():
+        statement = insert(ChatMember).values(values)
+        result = await session.execute(statement)
+    return result.rowcount
+
+
+async def chat_member_apply_batch(Session: sessionmaker,
+                                  upsert_values: List[dict],
+                                  delete_keys: List[Tuple[int, int]],
+                                  users: Optional[List[dict]] = None) -> None:
+    """
+    Apply a batch of ChatMember changes in a single transaction.
+    Each item of upsert_values must have chat_id, user_id and status keys (see chat_member_create),
+    existing rows get their status updated. Each item of delete_keys is a (chat_id, user_id) pair.
+    Users are stored first, so new members do not violate the user foreign key.
+
+    :param Session: DB session object
+    :param upsert_values: List of dictionaries of ChatMember attributes to insert or update
+    :param delete_keys: List of (chat_id, user_id) primary keys to delete
+    :param users: Optional list of dictionaries of User attributes of members (see user_upsert_many)
+    """
+    if not upsert_values and not delete_keys:
+        return
+
+    async with Session() as session, session.begin():
+        if users:
+            columns = [key for key in users[0] if key not in ('id', 'role')]
+            statement = upsert_changed(Session, User, None, ['id'], columns)
+            await session.execute(statement, users)
+        if upsert_values:
+            statement = upsert_changed(Session, ChatMember, upsert_values, ['chat_id', 'user_id'], ['status'])
+            await session.execute(statement)
+        if delete_keys:
+            statement = delete(ChatMember).where(tuple_(ChatMember.chat_id, ChatMember.user_id).in_(delete_keys))
+            await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    if users:
+        forget_cached(user_read_cache, (user['id'] for user in users))
+
+
 async def chat_member_update(Session: sessionmaker, **kwargs) -> Optional[ChatMember]:
     """
     Update telegram ChatMember object in database. kwargs may have the following attributes:
@@ -359,17 +593,23 @@ async def chat_member_update(Session: sessionmaker, **kwargs) -> Optional[ChatMe
     :param kwargs: Contain dictionary of ChatMember attributes
     :return: ChatMember object on success, None on failure
     """
+    kwargs = {key: value for key, value in kwargs.items() if key in CHAT_MEMBER_COLUMNS}
     if not (kwargs.get('chat_id', None) and kwargs.get('user_id', None)):
         return None
 
-    async with Session() as session:
+    changes = {key: value for key, value in kwargs.items() if key not in ('chat_id', 'user_id')}
+    if not changes:
+        return await chat_member_read(Session, chat_id=kwargs['chat_id'], user_id=kwargs['user_id'])
+    async with Session() as session, session.begin():
+        # Row is not rewritten when no column differs
         statement = update(ChatMember).where(ChatMember.chat_id == kwargs['chat_id'],
-                                             ChatMember.user_id == kwargs['user_id']).values(**kwargs)
+                                             ChatMember.user_id == kwargs['user_id'],
+                                             distinct_from(ChatMember, changes)).values(**changes)
+        await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+        statement = select_chat_member(kwargs['chat_id'], kwargs['user_id'])
         result = await session.execute(statement)
-        await session.commit()
-        chat_member: ChatMember = await chat_member_read(Session, chat_id=kwargs['chat_id'],
-                                                         user_id=kwargs['user_id'])
-        return chat_member
+        chat_member: ChatMember = result.scalar()
+    return chat_member
 
 
 async def chat_member_delete(Session: sessionmaker, **kwargs) -> bool:
@@ -390,10 +630,69 @@ async def chat_member_delete(Session: sessionmaker, **kwargs) -> bool:
     if not (kwargs.get('chat_id', None) and kwargs.get('user_id', None)):
         return False
 
-    async with Session() as session:
+    async with Session() as session, session.begin():
         statement = delete(ChatMember).where(ChatMember.chat_id == kwargs['chat_id'],
                                              ChatMember.user_id == kwargs['user_id'])
-        result = await session.execute(statement)
-        await session.commit()
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    return True if result.rowcount else False
 
-        return True if result.rowcount else False
+
+async def chat_member_delete_many(Session: sessionmaker, keys: List[Tuple[int, int]]) -> int:
+    """
+    Delete several telegram ChatMember objects from database with a single DELETE statement.
+
+    :param Session: DB session object
+    :param keys: List of (chat_id, user_id) primary keys
+    :return: Number of deleted rows
+    """
+    if not keys:
+        return 0
+
+    async with Session() as session, session.begin():
+        statement = delete(ChatMember).where(tuple_(ChatMember.chat_id, ChatMember.user_id).in_(keys))
+        result = await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+    return result.rowcount
+
+
+async def telegram_state_upsert(Session: sessionmaker,
+                                user: dict,
+                                chat: Optional[dict] = None,
+                                members: Optional[List[dict]] = None,
+                                left_members: Optional[List[Tuple[int, int]]] = None
+                                ) -> Tuple[Optional[User], Optional[Chat], Optional[ChatMember]]:
+    """
+    Store telegram User, Chat and ChatMember objects of an incoming update in a single transaction
+    with INSERT ... ON CONFLICT DO UPDATE statements and read them back in the same session.
+
+    :param Session: DB session object
+    :param user: Dictionary of User attributes (see user_create), role is only used for a new user
+    :param chat: Optional dictionary of Chat attributes (see chat_create)
+    :param members: Optional list of dictionaries of ChatMember attributes (see chat_member_create),
+                    first item must be the member of user in chat
+    :param left_members: Optional list of (chat_id, user_id) pairs of ChatMember objects to delete
+    :return: Tuple of User, Chat and ChatMember of user in chat, any of them may be None
+    """
+    if not user.get('id', None) or not user.get('first_name', None):
+        return None, None, None
+
+    # Writes and reads back share one transaction, so the update costs a single commit
+    async with Session() as session, session.begin():
+        statement = upsert_changed(Session, User, [user], ['id'], [key for key in user if key not in ('id', 'role')])
+        await session.execute(statement)
+        if chat:
+            statement = upsert_changed(Session, Chat, [chat], ['id'], [key for key in chat if key != 'id'])
+            await session.execute(statement)
+        if members:
+            statement = upsert_changed(Session, ChatMember, members, ['chat_id', 'user_id'], ['status'])
+            await session.execute(statement)
+        if left_members:
+            statement = delete(ChatMember).where(tuple_(ChatMember.chat_id, ChatMember.user_id).in_(left_members))
+            await session.execute(statement, execution_options=BULK_DML_OPTIONS)
+
+        db_user: User = (await session.execute(select_user(user['id']))).scalar()
+        if not chat:
+            return db_user, None, None
+        db_chat: Chat = (await session.execute(select_chat(chat['id']))).scalar()
+        statement = select_chat_member(chat['id'], user['id'])
+        db_chat_member: ChatMember = (await session.execute(statement)).scalar()
+        return db_user, db_chat, db_chat_member
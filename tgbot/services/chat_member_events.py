@@ -0,0 +1,117 @@
+"""
+Batch writer for chat member service events
+"""
+import asyncio
+import logging
+from typing import Optional, Dict, Tuple
+
+from sqlalchemy.orm import sessionmaker
+
+from tgbot.models.telegram_object import chat_member_apply_batch
+
+MAX_BATCH_SIZE = 100
+FLUSH_INTERVAL = 0.1
+
+
+class ChatMemberEvents:
+    """
+    Collects join/leave chat member events into a queue and writes them to database
+    in batches of up to max_batch_size events or every flush_interval seconds
+    """
+
+    def __init__(self, Session: sessionmaker,
+                 max_batch_size: int = MAX_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 logger: Optional[logging.Logger] = None, ):
+        self.__Session = Session
+        self.__max_batch_size = max_batch_size
+        self.__flush_interval = flush_interval
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__task: Optional[asyncio.Task] = None
+        self.__logger = logger or logging.getLogger(self.__class__.__module__)
+
+    def start(self):
+        if not self.__task:
+            self.__task = asyncio.create_task(self.__drain_loop())
+
+    async def close(self):
+        """Flush pending events and stop the drain loop"""
+        if self.__task:
+            await self.__queue.put(None)
+            await self.__task
+            self.__task = None
+
+    async def join(self, chat_id: int, user_id: int, status: str, user: Optional[dict] = None):
+        """user is a dictionary of User attributes, it is stored in the same transaction as the member"""
+        await self.__queue.put((chat_id, user_id, status, user))
+
+    async def leave(self, chat_id: int, user_id: int):
+        await self.__queue.put((chat_id, user_id, None, None))
+
+    async def __drain_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self.__queue.get()
+            if event is None:
+                return
+            events = [event]
+            stop = False
+            deadline = loop.time() + self.__flush_interval
+            while len(events) < self.__max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.__queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                events.append(event)
+            await self.__flush(events)
+            if stop:
+                return
+
+    async def __flush(self, events):
+        # The last event for a chat member wins
+        members: Dict[Tuple[int, int], Optional[str]] = {}
+        users: Dict[int, dict] = {}
+        for chat_id, user_id, status, user in events:
+            members[(chat_id, user_id)] = status
+            if user:
+                users[user_id] = user
+        upsert_values = [{'chat_id': chat_id, 'user_id': user_id, 'status': status}
+                         for (chat_id, user_id), status in members.items() if status is not None]
+        delete_keys = [key for key, status in members.items() if status is None]
+        # A transient error is retried once for the whole batch
+        for attempt in range(2):
+            try:
+                await chat_member_apply_batch(self.__Session, upsert_values, delete_keys, list(users.values()))
+                self.__logger.info("Chat members batch saved: %i joined, %i left",
+                                   len(upsert_values), len(delete_keys))
+                return
+            except Exception as e:
+                self.__logger.error("Error occurred while saving chat members batch (attempt %i). Error: %r",
+                                    attempt + 1, e)
+        # Apply events one by one so a single bad event does not drop the rest of the batch
+        lost = []
+        for (chat_id, user_id), status in members.items():
+            user = users.get(user_id)
+            try:
+                if status is None:
+                    await chat_member_apply_batch(self.__Session, [], [(chat_id, user_id)])
+                else:
+                    await chat_member_apply_batch(self.__Session,
+                                                  [{'chat_id': chat_id, 'user_id': user_id, 'status': status}],
+                                                  [],
+                                                  [user] if user else None)
+            except Exception as e:
+                self.__logger.error("Error occurred while saving chat member %r. Error: %r", (chat_id, user_id), e)
+                lost.append((chat_id, user_id))
+        if lost:
+            self.__logger.error("Chat member events lost for %i of %i (chat_id, user_id) pairs: %r",
+                                len(lost), len(members), lost)
+        else:
+            self.__logger.info("Chat members batch saved one by one: %i joined, %i left",
+                               len(upsert_values), len(delete_keys))
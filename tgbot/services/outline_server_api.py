@@ -1,13 +1,17 @@
 """
 API wrapper for Outline VPN
 """
+import asyncio
+import json
 import logging
+import ssl
 from dataclasses import dataclass
 from typing import Optional
 
 import aiohttp
 from aiohttp import ClientSession
 from aiohttp.typedefs import StrOrURL
+from yarl import URL
 
 
 @dataclass(frozen=True)
@@ -15,6 +19,8 @@ class OutlineKey:
     """
     Describes a key in the Outline server
     """
+    # dataclass(slots=True) needs Python 3.10
+    __slots__ = ('key_id', 'name', 'password', 'port', 'method', 'access_url', 'used_bytes')
 
     key_id: int
     name: str
@@ -25,6 +31,16 @@ class OutlineKey:
     used_bytes: int
 
 
+def outline_ssl_context() -> ssl.SSLContext:
+    """
+    SSL context for Outline servers, they use self-signed certificates which can not be verified
+    """
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
 class OutlineVPNException(BaseException):
     pass
 
@@ -34,14 +50,20 @@ class OutlineVPN:
     An Outline VPN connection
     """
 
-    def __init__(self, api_url: Optional[StrOrURL] = None,
-                 session: Optional[ClientSession] = None,
+    def __init__(self, api_url: Optional[StrOrURL],
+                 session: ClientSession,
                  logger: Optional[logging.Logger] = None, ):
-        self.__session = session or ClientSession()
+        # session is shared by all clients, its connector owns keep-alive and SSL settings
+        self.__session = session
         self.__api_url = api_url
-        self.__keys_url = f"{api_url}/access-keys/"
-        self.__metrics_url = f"{api_url}/metrics/transfer"
+        # URLs are parsed once per api_url, aiohttp uses URL objects as is
+        self.__keys_url = URL(f"{api_url}/access-keys/")
+        self.__metrics_url = URL(f"{api_url}/metrics/transfer")
         self.__logger = logger or logging.getLogger(self.__class__.__module__)
+        # Last transfer metrics, they are revalidated with ETag or reused when the body is the same
+        self.__metrics_etag: Optional[str] = None
+        self.__metrics_body: Optional[bytes] = None
+        self.__metrics: Optional[dict] = None
 
     @property
     def session(self):
@@ -57,38 +79,42 @@ class OutlineVPN:
 
     @api_url.setter
     def api_url(self, api_url: StrOrURL):
-        self.__keys_url = f"{api_url}/access-keys/"
-        self.__metrics_url = f"{api_url}/metrics/transfer"
+        self.__keys_url = URL(f"{api_url}/access-keys/")
+        self.__metrics_url = URL(f"{api_url}/metrics/transfer")
         self.__api_url = api_url
 
-    async def get_keys(self):
-        """Get all keys in the outline server"""
-        server_keys = None
-        metrics = None
+    def __key_url(self, key_id: int) -> URL:
+        return self.__keys_url / str(key_id)
 
-        async with self.session.get(self.__keys_url, verify_ssl=False) as response:
+    async def __get_access_keys(self) -> Optional[dict]:
+        async with self.session.get(self.__keys_url) as response:
             if response.status == 200:
                 try:
-                    server_keys = await response.json(encoding='utf-8')
-                except aiohttp.ClientError as err:
+                    return json.loads(await response.read())
+                except (aiohttp.ClientError, ValueError) as err:
                     self.__logger.error("Error while fetching keys: %r.", err)
+        return None
 
-        if server_keys and "accessKeys" in server_keys:
-            metrics = await self.get_transferred_data()
+    async def get_keys(self):
+        """Get all keys in the outline server"""
+        # Keys and metrics are independent requests, so they are sent concurrently
+        server_keys, metrics = await asyncio.gather(self.__get_access_keys(), self.get_transferred_data())
 
-        if not server_keys or not metrics:
+        if not server_keys or "accessKeys" not in server_keys or not metrics:
             raise Exception("Unable to retrieve keys")
+        bytes_transferred = metrics.get("bytesTransferredByUserId") or {}
         result = []
         for key in server_keys["accessKeys"]:
+            key_id = key.get("id")
             result.append(
                 OutlineKey(
-                    key_id=int(key.get("id")),
+                    key_id=int(key_id),
                     name=key.get("name"),
                     password=key.get("password"),
                     port=key.get("port"),
                     method=key.get("method"),
                     access_url=key.get("accessUrl"),
-                    used_bytes=metrics.get("bytesTransferredByUserId").get(key.get("id")) or 0,
+                    used_bytes=bytes_transferred.get(key_id) or 0,
                 )
             )
         return result
@@ -96,11 +122,11 @@ class OutlineVPN:
     async def create_key(self) -> OutlineKey:
         """Create a new key"""
         key = None
-        async with self.session.post(self.__keys_url, verify_ssl=False) as response:
+        async with self.session.post(self.__keys_url) as response:
             if response.status == 201:
                 try:
-                    key = await response.json(encoding='utf-8')
-                except aiohttp.ClientError as err:
+                    key = json.loads(await response.read())
+                except (aiohttp.ClientError, ValueError) as err:
                     self.__logger.error("Error while creating keys: %r.", err)
         if key:
             return OutlineKey(
@@ -117,34 +143,41 @@ class OutlineVPN:
 
     async def delete_key(self, key_id: int) -> bool:
         """Delete a key"""
-        async with self.session.delete(f"{self.__keys_url}/{key_id}", verify_ssl=False) as response:
+        async with self.session.delete(self.__key_url(key_id)) as response:
             return response.status == 204
 
     async def rename_key(self, key_id: int, new_name: str):
         """Rename a key"""
         data = {"name": new_name}
-        async with self.session.put(f"{self.__keys_url}/{key_id}/name", json=data, verify_ssl=False) as response:
+        async with self.session.put(self.__key_url(key_id) / "name", json=data) as response:
             return response.status == 204
 
     async def add_data_limit(self, key_id: int, limit_bytes: int) -> bool:
         """Set data limit for a key (in bytes)"""
         data = {"limit": {"bytes": limit_bytes}}
-        async with self.session.put(f"self.__keys_url/{key_id}/data-limit", json=data, verify_ssl=False) as response:
+        async with self.session.put(self.__key_url(key_id) / "data-limit", json=data) as response:
             return response.status == 204
 
     async def delete_data_limit(self, key_id: int) -> bool:
         """Removes data limit for a key"""
-        async with self.session.delete(f"self.__keys_url/{key_id}/data-limit", verify_ssl=False) as response:
+        async with self.session.delete(self.__key_url(key_id) / "data-limit") as response:
             return response.status == 204
 
     async def get_transferred_data(self):
         """Gets how much data all keys have used"""
         metrics = None
-        async with self.session.get(self.__metrics_url, verify_ssl=False) as response:
-            if response.status == 200:
+        headers = {"If-None-Match": self.__metrics_etag} if self.__metrics_etag else None
+        async with self.session.get(self.__metrics_url, headers=headers) as response:
+            if response.status == 304:
+                metrics = self.__metrics
+            elif response.status == 200:
                 try:
-                    metrics = await response.json(encoding='utf-8')
-                except aiohttp.ClientError as err:
+                    body = await response.read()
+                    metrics = self.__metrics if body == self.__metrics_body else json.loads(body)
+                    self.__metrics_etag = response.headers.get("ETag")
+                    self.__metrics_body = body
+                    self.__metrics = metrics
+                except (aiohttp.ClientError, ValueError) as err:
                     self.__logger.error("Error while fetching metrics: %r.", err)
 
         if not metrics: